@@ -1,17 +1,31 @@
 import logging
-import requests
 import cv2
 import numpy as np
 from pyzbar.pyzbar import decode
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, ContextTypes, filters
-from telegram.error import BadRequest
-import re
+from telegram.ext import Application, BasePersistence, PersistenceInput, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, ConversationHandler, ContextTypes, filters
+from telegram.error import BadRequest, RetryAfter, TelegramError
+import asyncio
+import base64
+import contextlib
+import contextvars
+import copy
+import cProfile
+import functools
+import gc
+import hashlib
+import itertools
+from collections import Counter, OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
 import tempfile
 import os
-import csv
+import pstats
+import random
+import time
 import io
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from snapshot import read_snapshot, write_snapshot
+from split_engine import Receipt, CsvFormatError, is_valid_qr, fetch_receipt_items, products_from_items, parse_products_csv
 
 # Настройки
 logging.basicConfig(
@@ -27,375 +41,450 @@ logger = logging.getLogger(__name__)
     SELECTING_PRODUCT_PARTICIPANTS, PROCESSING_QR, PROCESSING_CSV, CONFIRMING_ASSIGNMENTS
 ) = range(10)
 
-# API для чека и платежей
-FNS_API_URL = "https://proverkacheka.com/api/v1/check/get"
-FNS_API_KEY = os.getenv("FNS_API_KEY", "TOKEN")
+STATE_NAMES = {
+    SELECTING_ACTION: "SELECTING_ACTION", ADDING_MEMBERS: "ADDING_MEMBERS", SELECTING_PAYER: "SELECTING_PAYER",
+    ADDING_PRODUCT_NAME: "ADDING_PRODUCT_NAME", ADDING_PRODUCT_PRICE: "ADDING_PRODUCT_PRICE",
+    SELECTING_PRODUCT_TYPE: "SELECTING_PRODUCT_TYPE", SELECTING_PRODUCT_PARTICIPANTS: "SELECTING_PRODUCT_PARTICIPANTS",
+    PROCESSING_QR: "PROCESSING_QR", PROCESSING_CSV: "PROCESSING_CSV", CONFIRMING_ASSIGNMENTS: "CONFIRMING_ASSIGNMENTS",
+}
+
+# Выборочное профилирование обновлений (0 — выключено, 0.01 — каждое сотое)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# Статичные клавиатуры строятся один раз при запуске
+START_MENU = ReplyKeyboardMarkup([["Добавить участников", "Начать расчет"]], one_time_keyboard=True)
+ADD_MEMBERS_MENU = ReplyKeyboardMarkup([["Добавить участников"]], one_time_keyboard=True)
+PRODUCT_MENU = ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+PRODUCT_TYPE_MENU = ReplyKeyboardMarkup([["Общий", "Индивидуальный"]], one_time_keyboard=True)
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# API для платежей
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "your_payment_provider_token")  # Замените на реальный токен
 
+# Лимиты сообщений Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096  # в кодовых единицах UTF-16
+MAX_MESSAGE_PARTS = 3  # больше частей — отчет уходит файлом
+
+# Callback-данные: версия схемы и коды действий
+CALLBACK_VERSION = 1
+(
+    CB_DONE, CB_NEXT, CB_PREV, CB_CHANGE_TYPE, CB_ASSIGN, CB_ASSIGN_ALL, CB_PAY, CB_PAY_ALL,
+    CB_CLAIM, CB_JOIN, CB_PAGE, CB_SHARE, CB_MANUAL
+) = range(13)
+
 # Глобальное хранилище
 user_data = {}
 
-class Receipt:
-    def __init__(self):
-        self.payer = None
-        self.items = []
-        self.shared_items = []
-    
-    def add_item(self, name, price, quantity=1, members=None):
-        if members:
-            self.items.append({"name": name, "price": price, "quantity": quantity, "members": members})
-        else:
-            self.shared_items.append({"name": name, "price": price, "quantity": quantity})
+# Ограничения на тяжелые операции (QR, CSV, расчет с диаграммой)
+MAX_USER_IN_FLIGHT = int(os.getenv("MAX_USER_IN_FLIGHT", "1"))
+MAX_HEAVY_OPERATIONS = int(os.getenv("MAX_HEAVY_OPERATIONS", str(os.cpu_count() or 2)))
+HEAVY_QUEUE_LIMIT = int(os.getenv("HEAVY_QUEUE_LIMIT", "20"))
+
+# Счетчики для /stats
+metrics = Counter()
+
+# Кэш разобранных загрузок (фото чеков, CSV, строки QR)
+UPLOAD_CACHE_SIZE = int(os.getenv("UPLOAD_CACHE_SIZE", "512"))
+
+# Снимок сессий для перезапуска без потери расчетов
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "sessions.snapshot")
+
+# Доска распределения в групповых чатах
+BOARD_PAGE_SIZE = 20
+# Telegram пропускает около 20 сообщений в минуту на группу, поэтому доска правится не чаще раза в 3 секунды
+BOARD_EDIT_DELAY = float(os.getenv("BOARD_EDIT_DELAY", "3.0"))  # секунды, за которые нажатия сливаются в одно редактирование
+BOARD_MAX_RETRY_DELAY = 60.0  # предел паузы между повторами после сетевых ошибок
+
+# Долги завершенных расчетов для выставления счетов
+MAX_SETTLEMENTS = 1000
+CHECKOUT_TIMEOUT = 300  # секунды от pre-checkout до успешного платежа
+settlements = {}
+settlement_ids = itertools.count(1)
+
+class AdmissionControl:
+    """Ограничивает тяжелые операции: не больше N на пользователя и общий лимит с очередью"""
+    def __init__(self, per_user_limit, heavy_limit, queue_limit):
+        self.per_user_limit = per_user_limit
+        self.queue_limit = queue_limit
+        self.heavy = asyncio.Semaphore(heavy_limit)
+        self.in_flight = {}
+        self.waiting = 0
     
-    def calculate(self, members):
-        calculations = {member: 0 for member in members}
-        
-        # Общие товары
-        for item in self.shared_items:
-            share = (item['price'] * item['quantity']) / len(members)
-            for member in members:
-                calculations[member] += share
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id, operation):
+        """Контекст тяжелой операции; отдает False, если операцию нужно отклонить"""
+        if self.in_flight.get(user_id, 0) >= self.per_user_limit:
+            metrics[f"{operation}.rejected_user"] += 1
+            yield False
+            return
+        if self.heavy.locked() and self.waiting >= self.queue_limit:
+            metrics[f"{operation}.rejected_busy"] += 1
+            yield False
+            return
         
-        # Индивидуальные товары
-        for item in self.items:
-            share = (item['price'] * item['quantity']) / len(item['members'])
-            for member in item['members']:
-                calculations[member] += share
-        
-        # Формируем итог
-        result = []
-        total = sum(item['price'] * item['quantity'] for item in self.shared_items + self.items)
-        result.append(f"Общая сумма: {total:.2f}₽")
-        result.append(f"Оплатил(а): {self.payer}")
-        
-        debts = []
-        for member, amount in calculations.items():
-            if member != self.payer and amount > 0:
-                debts.append((member, amount))
-                result.append(f"{member} должен {amount:.2f}₽ {self.payer}")
-        
-        return "\n".join(result), debts
+        self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+        try:
+            if self.heavy.locked():
+                metrics[f"{operation}.queued"] += 1
+            self.waiting += 1
+            try:
+                await self.heavy.acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                metrics[f"{operation}.admitted"] += 1
+                yield True
+            finally:
+                self.heavy.release()
+        finally:
+            self.in_flight[user_id] -= 1
+            if not self.in_flight[user_id]:
+                del self.in_flight[user_id]
+
+admission = AdmissionControl(MAX_USER_IN_FLIGHT, MAX_HEAVY_OPERATIONS, HEAVY_QUEUE_LIMIT)
+
+def heavy_operation(operation):
+    """Декоратор обработчика: пропускает его через AdmissionControl или отвечает «занято»"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+            async with admission.admit(update.effective_user.id, operation) as admitted:
+                if admitted:
+                    return await handler(update, context, *args)
+            logger.warning(f"Rejected {operation} for user {update.effective_user.id}: busy")
+            await (update.message or update.callback_query.message).reply_text(
+                "Бот сейчас занят обработкой ваших или чужих запросов. Попробуйте через минуту."
+            )
+            # None оставляет диалог в текущем состоянии
+            return None
+        return wrapper
+    return decorator
+
+async def busy_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отвечает на обновления чата, пока его тяжелый обработчик еще работает"""
+    metrics["waiting.rejected_user"] += 1
+    text = "Еще обрабатываю предыдущий запрос. Подождите немного и попробуйте снова."
+    if update.callback_query:
+        await update.callback_query.answer(text)
+    elif update.effective_message:
+        await update.effective_message.reply_text(text)
+
+class UploadCache:
+    """LRU-кэш: ключ загрузки (file_unique_id, хэш содержимого или строка QR) -> список продуктов"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
     
-    def generate_verification_list(self, members):
-        """Генерирует список для сверки: кто за что платит"""
-        def truncate_name(name, max_length=50):
-            """Обрезает длинные названия продуктов"""
-            return name[:max_length] + "..." if len(name) > max_length else name
-        
-        result = ["\n--- Список для сверки ---"]
-        
-        # Общие товары
-        if self.shared_items:
-            result.append("Общие товары (делятся на всех):")
-            for item in self.shared_items:
-                result.append(
-                    f"- {truncate_name(item['name'])}: {item['price']:.2f}₽ x {item['quantity']} "
-                    f"(все участники: {', '.join(members)})"
-                )
-        
-        # Индивидуальные товары
-        if self.items:
-            result.append("Индивидуальные товары:")
-            for item in self.items:
-                result.append(
-                    f"- {truncate_name(item['name'])}: {item['price']:.2f}₽ x {item['quantity']} "
-                    f"(участники: {', '.join(item['members'])})"
-                )
-        
-        if not self.shared_items and not self.items:
-            result.append("Нет товаров для сверки.")
-        
-        return "\n".join(result)
+    def get(self, key):
+        kind = key.split(':', 1)[0]
+        products = self.entries.get(key)
+        if products is None:
+            metrics[f"upload_cache.{kind}.miss"] += 1
+            return None
+        self.entries.move_to_end(key)
+        metrics[f"upload_cache.{kind}.hit"] += 1
+        # Копии: сессия меняет тип продуктов
+        return [dict(product) for product in products]
     
-    def generate_verification_csv(self, members):
-        """Генерирует CSV с детализацией товаров, участников и итогами"""
-        output = io.StringIO()
-        writer = csv.writer(output, delimiter=';', lineterminator='\n')
-        writer.writerow(['Тип', 'Товар', 'Цена', 'Количество', 'Участники'])
-        
-        # Общие товары
-        for item in self.shared_items:
-            writer.writerow([
-                'Общий',
-                item['name'],
-                f"{item['price']:.2f}",
-                item['quantity'],
-                ', '.join(members)
-            ])
-        
-        # Индивидуальные товары
-        for item in self.items:
-            writer.writerow([
-                'Индивидуальный',
-                item['name'],
-                f"{item['price']:.2f}",
-                item['quantity'],
-                ', '.join(item['members'])
-            ])
-        
-        # Добавляем итоги
-        writer.writerow([])  # Пустая строка для разделения
-        calculations = {member: 0 for member in members}
-        for item in self.shared_items:
-            share = (item['price'] * item['quantity']) / len(members)
-            for member in members:
-                calculations[member] += share
-        for item in self.items:
-            share = (item['price'] * item['quantity']) / len(item['members'])
-            for member in item['members']:
-                calculations[member] += share
-        total = sum(item['price'] * item['quantity'] for item in self.shared_items + self.items)
-        
-        writer.writerow([f"Общая сумма: {total:.2f}₽"])
-        writer.writerow([f"Оплатил(а): {self.payer}"])
-        for member, amount in calculations.items():
-            if member != self.payer:
-                writer.writerow([f"{member} должен {amount:.2f}₽ {self.payer}"])
-        
-        csv_content = output.getvalue()
-        output.close()
-        return csv_content
+    def put(self, key, products):
+        self.entries[key] = tuple(dict(product) for product in products)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def hit_rates(self):
+        rates = {}
+        for name in metrics:
+            if name.startswith("upload_cache.") and name.endswith(".hit"):
+                kind = name[len("upload_cache."):-len(".hit")]
+                hits, misses = metrics[name], metrics[f"upload_cache.{kind}.miss"]
+                rates[kind] = hits / (hits + misses)
+        return rates
+
+upload_cache = UploadCache(UPLOAD_CACHE_SIZE)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_data[user_id] = {
+    chat_id = update.effective_chat.id
+    user_data[chat_id] = {
         "members": [],
         "receipt": Receipt(),
         "current_product": {},
         "csv_products": [],
         "product_assignments": {},
-        "current_product_index": 0
+        "current_product_index": 0,
+        "payer_menu": None,
+        "keyboards": {},
+        # Групповой режим: сессия общая на чат, каждый отмечает свои товары сам
+        "group": update.effective_chat.type != "private",
+        "owner": update.effective_user.id,
+        "claimants": {},
+        "product_versions": {},
+        "claim_versions": {},
+        "board_page": 0,
+        "board_message": None,
+        "board_dirty": False,
+        # До этого момента (time.monotonic) Telegram просил не редактировать сообщения чата
+        "board_retry_at": 0.0,
+        "finishing": False
     }
     
-    keyboard = [["Добавить участников", "Начать расчет"]]
     await update.message.reply_text(
         "Добро пожаловать в бот для расчета общих покупок!\n\n"
         "Сначала добавьте участников, затем начните расчет.",
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+        reply_markup=START_MENU
     )
     return SELECTING_ACTION
 
 async def select_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     text = update.message.text
     
     if text == "Добавить участников":
         await update.message.reply_text(
             "Введите имена участников через запятую:\n"
             "Например: Алексей, Мария, Иван, Елена",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ADDING_MEMBERS
     elif text == "Начать расчет":
-        if not user_data[user_id]["members"]:
+        if not user_data[chat_id]["members"]:
             await update.message.reply_text(
                 "Сначала нужно добавить участников!",
-                reply_markup=ReplyKeyboardMarkup([["Добавить участников"]], one_time_keyboard=True)
+                reply_markup=ADD_MEMBERS_MENU
             )
             return SELECTING_ACTION
         
-        keyboard = [[member] for member in user_data[user_id]["members"]]
         await update.message.reply_text(
             "Кто оплатил покупки?",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+            reply_markup=payer_menu(user_data[chat_id])
         )
         return SELECTING_PAYER
     return SELECTING_ACTION
 
+def payer_menu(session):
+    """Клавиатура выбора плательщика; строится при первом показе и кэшируется в сессии"""
+    if session["payer_menu"] is None:
+        session["payer_menu"] = ReplyKeyboardMarkup([[member] for member in session["members"]], one_time_keyboard=True)
+    return session["payer_menu"]
+
 async def add_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     text = update.message.text
     
     members = [name.strip() for name in text.split(",") if name.strip()]
     if not members:
         await update.message.reply_text(
             "Неверный формат. Введите имена через запятую:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ADDING_MEMBERS
     
-    user_data[user_id]["members"] = members
-    keyboard = [["Добавить участников", "Начать расчет"]]
+    user_data[chat_id]["members"] = members
+    user_data[chat_id]["payer_menu"] = None
+    user_data[chat_id]["keyboards"].clear()
     await update.message.reply_text(
         f"Участники добавлены: {', '.join(members)}\n\n"
         "Что делаем дальше?",
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+        reply_markup=START_MENU
     )
     return SELECTING_ACTION
 
 async def select_payer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     payer = update.message.text
     
-    if payer not in user_data[user_id]["members"]:
+    if payer not in user_data[chat_id]["members"]:
         await update.message.reply_text(
             "Выберите участника из списка:",
-            reply_markup=ReplyKeyboardMarkup([[member] for member in user_data[user_id]["members"]], one_time_keyboard=True)
+            reply_markup=payer_menu(user_data[chat_id])
         )
         return SELECTING_PAYER
     
-    user_data[user_id]["receipt"].payer = payer
-    keyboard = [["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]]
+    user_data[chat_id]["receipt"].payer = payer
     await update.message.reply_text(
         f"Оплатил(а): {payer}\n\n"
         "Теперь добавляйте продукты:",
-        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+        reply_markup=PRODUCT_MENU
     )
     return ADDING_PRODUCT_NAME
 
 async def add_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     text = update.message.text
     
     if text == "Добавить продукт":
         await update.message.reply_text(
             "Введите название продукта:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ADDING_PRODUCT_NAME
     elif text == "Сканировать QR-код":
         await update.message.reply_text(
             "Отправьте фото QR-кода или введите данные вручную в формате:\n"
             "t=20230101T1200&s=1000.00&fn=1234567890&i=12345&fp=1234567890",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return PROCESSING_QR
     elif text == "Загрузить CSV":
         await update.message.reply_text(
             "Отправьте CSV файл с колонками: Товар,Цена,Количество (Количество необязательно).\n"
             "Пример:\nТовар;Цена;Количество\nХлеб;100,50;2\nМолоко;60,75;1",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return PROCESSING_CSV
     elif text == "Завершить расчет":
         return await show_product_list(update, context)
     else:
-        user_data[user_id]["current_product"] = {"name": text}
+        user_data[chat_id]["current_product"] = {"name": text}
         await update.message.reply_text(
             "Теперь введите цену продукта:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ADDING_PRODUCT_PRICE
 
 async def add_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     text = update.message.text
     
     try:
         price = float(text.replace(',', '.'))
-        user_data[user_id]["current_product"]["price"] = price
+        user_data[chat_id]["current_product"]["price"] = price
         await update.message.reply_text(
             "Выберите тип товара:",
-            reply_markup=ReplyKeyboardMarkup([["Общий", "Индивидуальный"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_TYPE_MENU
         )
         return SELECTING_PRODUCT_TYPE
     except ValueError:
         await update.message.reply_text(
             "Неверный формат цены. Введите число:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ADDING_PRODUCT_PRICE
 
 async def select_product_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     text = update.message.text
     
     if text not in ["Общий", "Индивидуальный"]:
         await update.message.reply_text(
             "Выберите тип товара:",
-            reply_markup=ReplyKeyboardMarkup([["Общий", "Индивидуальный"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_TYPE_MENU
         )
         return SELECTING_PRODUCT_TYPE
     
     # Сохраняем тип товара
-    user_data[user_id]["current_product"]["type"] = "shared" if text == "Общий" else "individual"
-    user_data[user_id]["csv_products"].append(user_data[user_id]["current_product"])
+    user_data[chat_id]["current_product"]["type"] = "shared" if text == "Общий" else "individual"
+    user_data[chat_id]["csv_products"].append(user_data[chat_id]["current_product"])
     
     if text == "Общий":
         # Для общих товаров автоматически назначаем всех участников
-        product_index = len(user_data[user_id]["csv_products"]) - 1
-        user_data[user_id]["product_assignments"][product_index] = user_data[user_id]["members"].copy()
-        keyboard = [["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]]
+        product_index = len(user_data[chat_id]["csv_products"]) - 1
+        user_data[chat_id]["product_assignments"][product_index] = all_members_mask(user_data[chat_id]["members"])
         await update.message.reply_text(
-            f"Добавлен общий продукт: {user_data[user_id]['current_product']['name']} - {user_data[user_id]['current_product']['price']:.2f}₽",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+            f"Добавлен общий продукт: {user_data[chat_id]['current_product']['name']} - {user_data[chat_id]['current_product']['price']:.2f}₽",
+            reply_markup=PRODUCT_MENU
         )
         return ADDING_PRODUCT_NAME
     else:
         # Для индивидуальных товаров переходим к выбору участников
-        user_data[user_id]["current_product_index"] = len(user_data[user_id]["csv_products"]) - 1
+        user_data[chat_id]["current_product_index"] = len(user_data[chat_id]["csv_products"]) - 1
         return await show_product_list(update, context)
 
-async def show_product_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+def all_members_mask(members):
+    return (1 << len(members)) - 1
+
+def mask_to_members(mask, members):
+    """Список участников, отмеченных в битовой маске"""
+    return [member for i, member in enumerate(members) if mask >> i & 1]
+
+def product_keyboard(session, product_index):
+    """Кнопки продукта строятся один раз за сессию; отметки выбираются из готовых пар"""
+    key = (product_index, len(session["csv_products"]))
+    cached = session["keyboards"].get(key)
+    if cached is None:
+        member_buttons = [
+            (InlineKeyboardButton(member, callback_data=data), InlineKeyboardButton(f"{member} ✓", callback_data=data))
+            for member_index, member in enumerate(session["members"])
+            for data in [pack_callback(CB_ASSIGN, product_index, member_index)]
+        ]
+        all_data = pack_callback(CB_ASSIGN_ALL, product_index)
+        all_buttons = (InlineKeyboardButton("Все", callback_data=all_data), InlineKeyboardButton("Все ✓", callback_data=all_data))
+        
+        # Кнопка изменения типа: [для индивидуального, для общего]
+        type_data = pack_callback(CB_CHANGE_TYPE, product_index)
+        type_rows = (
+            [InlineKeyboardButton("Сделать общим", callback_data=type_data)],
+            [InlineKeyboardButton("Сделать индивидуальным", callback_data=type_data)],
+        )
+        
+        # Навигационные кнопки
+        nav_buttons = []
+        if product_index > 0:
+            nav_buttons.append(InlineKeyboardButton("Назад", callback_data=pack_callback(CB_PREV)))
+        if product_index < len(session["csv_products"]) - 1:
+            nav_buttons.append(InlineKeyboardButton("Далее", callback_data=pack_callback(CB_NEXT)))
+        else:
+            nav_buttons.append(InlineKeyboardButton("Готово", callback_data=pack_callback(CB_DONE)))
+        
+        cached = session["keyboards"][key] = (member_buttons, all_buttons, type_rows, nav_buttons)
+    return cached
+
+async def show_product_list(update: Update, context: ContextTypes.DEFAULT_TYPE, reply=False):
+    chat_id = update.effective_chat.id
+    session = user_data[chat_id]
     
-    if not user_data[user_id]["csv_products"] and not user_data[user_id]["receipt"].items and not user_data[user_id]["receipt"].shared_items:
+    if not session["csv_products"] and not session["receipt"].items and not session["receipt"].shared_items:
         await update.message.reply_text(
             "Не добавлено ни одного продукта!",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return ADDING_PRODUCT_NAME
     
+    # В группе сообщение открывает доску; по товарам распределяет только начавший расчет
+    if session["group"] and update.message:
+        return await show_claim_board(update, context)
+    
     if update.message:
-        user_data[user_id]["current_product_index"] = 0
+        session["current_product_index"] = 0
     
-    current_index = user_data[user_id]["current_product_index"]
-    if current_index >= len(user_data[user_id]["csv_products"]):
+    current_index = session["current_product_index"]
+    if current_index >= len(session["csv_products"]):
         await (update.message or update.callback_query.message).reply_text(
             "Все продукты распределены. Нажмите 'Готово' для завершения.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Готово", callback_data="done_assignments")]])
+            reply_markup=DONE_MARKUP
         )
         return CONFIRMING_ASSIGNMENTS
     
-    product = user_data[user_id]["csv_products"][current_index]
-    product_type = "Общий" if product.get("type") == "shared" else "Индивидуальный"
+    members = session["members"]
+    full_mask = all_members_mask(members)
+    product = session["csv_products"][current_index]
+    is_shared = product.get("type") == "shared"
+    product_type = "Общий" if is_shared else "Индивидуальный"
     message_parts = [
-        f"Продукт {current_index + 1} из {len(user_data[user_id]['csv_products'])} ({product_type}):",
+        f"Продукт {current_index + 1} из {len(session['csv_products'])} ({product_type}):",
         f"{product['name']} - {product['price']:.2f}₽ x {product.get('quantity', 1)}"
     ]
-    assigned = user_data[user_id]["product_assignments"].get(current_index, user_data[user_id]["members"] if product.get("type") == "shared" else [])
-    if assigned == user_data[user_id]["members"]:
-        message_parts.append(f"(все участники: {', '.join(assigned)})")
-    elif assigned:
-        message_parts.append(f"(участники: {', '.join(assigned)})")
+    mask = session["product_assignments"].get(current_index, full_mask if is_shared else 0)
+    if mask == full_mask:
+        message_parts.append(f"(все участники: {', '.join(members)})")
+    elif mask:
+        message_parts.append(f"(участники: {', '.join(mask_to_members(mask, members))})")
     else:
         message_parts.append("(участники: не выбраны)")
     
+    member_buttons, all_buttons, type_rows, nav_buttons = product_keyboard(session, current_index)
+    keyboard = [type_rows[is_shared], nav_buttons]
     # Кнопки для участников (только для индивидуальных товаров)
-    buttons = []
-    if product.get("type") == "individual":
-        buttons = [
-            InlineKeyboardButton(
-                f"{member} ✓" if member in assigned else member,
-                callback_data=f"assign_{current_index}_{member}"
-            )
-            for member in user_data[user_id]["members"]
-        ]
-        buttons.append(InlineKeyboardButton(
-            "Все ✓" if assigned == user_data[user_id]["members"] else "Все",
-            callback_data=f"assign_{current_index}_shared"
-        ))
-    
-    # Кнопка изменения типа
-    type_button = [InlineKeyboardButton(
-        "Сделать индивидуальным" if product.get("type") == "shared" else "Сделать общим",
-        callback_data=f"change_type_{current_index}"
-    )]
-    
-    # Навигационные кнопки
-    nav_buttons = []
-    if current_index > 0:
-        nav_buttons.append(InlineKeyboardButton("Назад", callback_data="prev_product"))
-    if current_index < len(user_data[user_id]["csv_products"]) - 1:
-        nav_buttons.append(InlineKeyboardButton("Далее", callback_data="next_product"))
-    else:
-        nav_buttons.append(InlineKeyboardButton("Готово", callback_data="done_assignments"))
-    
-    keyboard = [buttons, type_button, nav_buttons] if buttons else [type_button, nav_buttons]
+    if not is_shared:
+        buttons = [pair[mask >> i & 1] for i, pair in enumerate(member_buttons)]
+        buttons.append(all_buttons[mask == full_mask])
+        keyboard.insert(0, buttons)
     
     try:
-        if update.message:
-            await update.message.reply_text(
+        if update.message or reply:
+            await (update.message or update.callback_query.message).reply_text(
                 "\n".join(message_parts),
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
@@ -414,160 +503,588 @@ async def show_product_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Navigating to product index {current_index}")
     return CONFIRMING_ASSIGNMENTS
 
-async def handle_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+def pack_callback(action, *args):
+    """Кодирует callback_data: версия, код действия и аргументы (varint) в base64url"""
+    raw = bytearray((CALLBACK_VERSION, action))
+    for value in args:
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                raw.append(byte | 0x80)
+            else:
+                raw.append(byte)
+                break
+    return base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode('ascii')
+
+def unpack_callback(data):
+    """Декодирует callback_data, возвращает (действие, аргументы) или None"""
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except (ValueError, TypeError):
+        return None
+    if len(raw) < 2 or raw[0] != CALLBACK_VERSION:
+        return None
+    
+    args = []
+    value = shift = 0
+    for byte in raw[2:]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            args.append(value)
+            value = shift = 0
+    if shift:
+        return None
+    return raw[1], args
+
+# Inline-клавиатура «Готово» не зависит от сессии
+DONE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Готово", callback_data=pack_callback(CB_DONE))]])
+
+@heavy_operation("calculate")
+async def finish_assignments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     query = update.callback_query
-    await query.answer()
+    unassigned = [
+        i for i, product in enumerate(user_data[chat_id]["csv_products"])
+        if product.get("type") == "individual" and 
+        (i not in user_data[chat_id]["product_assignments"] or not user_data[chat_id]["product_assignments"][i])
+    ]
+    if unassigned:
+        await query.message.reply_text(
+            f"Не все индивидуальные продукты распределены! Выберите участников для продуктов: {', '.join(str(i + 1) for i in unassigned)}"
+        )
+        return CONFIRMING_ASSIGNMENTS
     
-    data = query.data
-    if data == "done_assignments":
-        unassigned = [
-            i for i, product in enumerate(user_data[user_id]["csv_products"])
-            if product.get("type") == "individual" and 
-            (i not in user_data[user_id]["product_assignments"] or not user_data[user_id]["product_assignments"][i])
-        ]
-        if unassigned:
-            await query.message.reply_text(
-                f"Не все индивидуальные продукты распределены! Выберите участников для продуктов: {', '.join(str(i + 1) for i in unassigned)}"
-            )
-            return CONFIRMING_ASSIGNMENTS
-        
-        logger.info(f"Product assignments: {user_data[user_id]['product_assignments']}")
-        receipt = user_data[user_id]["receipt"]
-        for i, product in enumerate(user_data[user_id]["csv_products"]):
-            members = user_data[user_id]["product_assignments"].get(i, user_data[user_id]["members"] if product.get("type") == "shared" else [])
-            receipt.add_item(
-                product["name"],
-                product["price"],
-                product.get("quantity", 1),
-                members if members != user_data[user_id]["members"] else None
-            )
-        
-        return await calculate(update, context)
-    
-    if data == "next_product":
-        current_index = user_data[user_id]["current_product_index"]
-        if user_data[user_id]["csv_products"][current_index].get("type") == "individual" and \
-           (current_index not in user_data[user_id]["product_assignments"] or not user_data[user_id]["product_assignments"][current_index]):
-            await query.message.reply_text(
-                "Выберите участников для текущего индивидуального продукта перед переходом к следующему!"
-            )
-            return CONFIRMING_ASSIGNMENTS
-        
-        user_data[user_id]["current_product_index"] += 1
-        logger.info(f"Navigating to product index {user_data[user_id]['current_product_index']}")
-        return await show_product_list(update, context)
+    # В группе «Готово» могут нажать несколько человек одновременно
+    if user_data[chat_id]["finishing"]:
+        return CONFIRMING_ASSIGNMENTS
+    user_data[chat_id]["finishing"] = True
     
-    if data == "prev_product":
-        if user_data[user_id]["current_product_index"] > 0:
-            user_data[user_id]["current_product_index"] -= 1
-            logger.info(f"Navigating to product index {user_data[user_id]['current_product_index']}")
-            return await show_product_list(update, context)
-        else:
-            await query.message.reply_text("Это первый продукт, назад нельзя!")
-            return CONFIRMING_ASSIGNMENTS
-    
-    # Обработка изменения типа товара
-    match = re.match(r"change_type_(\d+)", data)
-    if match:
-        product_index = int(match.group(1))
-        if product_index != user_data[user_id]["current_product_index"]:
-            await query.message.reply_text("Ошибка: продукт не соответствует текущему.")
-            return CONFIRMING_ASSIGNMENTS
-        
-        current_type = user_data[user_id]["csv_products"][product_index].get("type")
-        new_type = "individual" if current_type == "shared" else "shared"
-        user_data[user_id]["csv_products"][product_index]["type"] = new_type
-        if new_type == "shared":
-            user_data[user_id]["product_assignments"][product_index] = user_data[user_id]["members"].copy()
-        else:
-            user_data[user_id]["product_assignments"][product_index] = []
-        logger.info(f"Changed product {product_index} to type {new_type}")
-        return await show_product_list(update, context)
+    logger.info(f"Product assignments: {user_data[chat_id]['product_assignments']}")
+    receipt = user_data[chat_id]["receipt"]
+    members = user_data[chat_id]["members"]
+    full_mask = all_members_mask(members)
+    for i, product in enumerate(user_data[chat_id]["csv_products"]):
+        mask = user_data[chat_id]["product_assignments"].get(i, full_mask if product.get("type") == "shared" else 0)
+        receipt.add_item(
+            product["name"],
+            product["price"],
+            product.get("quantity", 1),
+            mask_to_members(mask, members) if mask != full_mask else None
+        )
     
-    # Обработка оплаты долга
-    match = re.match(r"pay_(.+)_(\d+\.\d+)", data)
-    if match:
-        member, amount = match.group(1), float(match.group(2))
-        try:
-            await context.bot.send_invoice(
-                chat_id=update.effective_chat.id,
-                title=f"Оплата долга {user_data[user_id]['receipt'].payer} от {member}",
-                description=f"Оплата долга за покупки: {member} должен {amount:.2f}₽ {user_data[user_id]['receipt'].payer}",
-                payload=f"debt_{member}_{amount}",
-                provider_token=PAYMENT_PROVIDER_TOKEN,
-                currency="RUB",
-                prices=[LabeledPrice(f"Долг {user_data[user_id]['receipt'].payer}", int(amount * 100))]
-            )
-            logger.info(f"Sent invoice for {member} to {user_data[user_id]['receipt'].payer}: {amount:.2f}₽")
-        except Exception as e:
-            logger.error(f"Error sending invoice: {e}")
-            await query.message.reply_text("Ошибка при создании платежа. Проверьте настройки провайдера.")
+    return await calculate(update, context)
+
+async def next_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    current_index = user_data[chat_id]["current_product_index"]
+    if user_data[chat_id]["csv_products"][current_index].get("type") == "individual" and \
+       (current_index not in user_data[chat_id]["product_assignments"] or not user_data[chat_id]["product_assignments"][current_index]):
+        await update.callback_query.message.reply_text(
+            "Выберите участников для текущего индивидуального продукта перед переходом к следующему!"
+        )
         return CONFIRMING_ASSIGNMENTS
     
-    # Обработка выбора участника
-    match = re.match(r"assign_(\d+)_(.+)", data)
-    if not match:
-        await query.message.reply_text("Ошибка обработки выбора. Попробуйте снова.")
+    user_data[chat_id]["current_product_index"] += 1
+    logger.info(f"Navigating to product index {user_data[chat_id]['current_product_index']}")
+    return await show_product_list(update, context)
+
+async def prev_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if user_data[chat_id]["current_product_index"] > 0:
+        user_data[chat_id]["current_product_index"] -= 1
+        logger.info(f"Navigating to product index {user_data[chat_id]['current_product_index']}")
+        return await show_product_list(update, context)
+    
+    await update.callback_query.message.reply_text("Это первый продукт, назад нельзя!")
+    return CONFIRMING_ASSIGNMENTS
+
+async def change_product_type(update: Update, context: ContextTypes.DEFAULT_TYPE, product_index):
+    chat_id = update.effective_chat.id
+    if product_index != user_data[chat_id]["current_product_index"]:
+        await update.callback_query.message.reply_text("Ошибка: продукт не соответствует текущему.")
         return CONFIRMING_ASSIGNMENTS
     
-    product_index = int(match.group(1))
-    selection = match.group(2)
+    current_type = user_data[chat_id]["csv_products"][product_index].get("type")
+    new_type = "individual" if current_type == "shared" else "shared"
+    user_data[chat_id]["csv_products"][product_index]["type"] = new_type
+    if new_type == "shared":
+        user_data[chat_id]["product_assignments"][product_index] = all_members_mask(user_data[chat_id]["members"])
+    else:
+        user_data[chat_id]["product_assignments"][product_index] = 0
+    logger.info(f"Changed product {product_index} to type {new_type}")
+    mark_product_changed(context, chat_id, product_index)
+    return await show_product_list(update, context)
+
+async def toggle_member(update: Update, context: ContextTypes.DEFAULT_TYPE, product_index, member_index=None):
+    """Переключает участника (или всех, если member_index не задан) для индивидуального продукта"""
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    members = user_data[chat_id]["members"]
     
-    if product_index != user_data[user_id]["current_product_index"]:
+    if product_index != user_data[chat_id]["current_product_index"]:
         await query.message.reply_text("Ошибка: продукт не соответствует текущему.")
         return CONFIRMING_ASSIGNMENTS
     
-    if user_data[user_id]["csv_products"][product_index].get("type") == "shared":
+    if user_data[chat_id]["csv_products"][product_index].get("type") == "shared":
         await query.message.reply_text("Для общих товаров участники фиксированы (все). Измените тип на индивидуальный, если нужно выбрать участников.")
         return CONFIRMING_ASSIGNMENTS
     
-    if product_index not in user_data[user_id]["product_assignments"]:
-        user_data[user_id]["product_assignments"][product_index] = []
+    mask = user_data[chat_id]["product_assignments"].get(product_index, 0)
+    full_mask = all_members_mask(members)
     
-    if selection == "shared":
-        if user_data[user_id]["product_assignments"][product_index] == user_data[user_id]["members"]:
-            user_data[user_id]["product_assignments"][product_index] = []
-        else:
-            user_data[user_id]["product_assignments"][product_index] = user_data[user_id]["members"].copy()
-    elif selection in user_data[user_id]["members"]:
-        if selection in user_data[user_id]["product_assignments"][product_index]:
-            user_data[user_id]["product_assignments"][product_index].remove(selection)
-        else:
-            user_data[user_id]["product_assignments"][product_index].append(selection)
+    if member_index is None:
+        mask = 0 if mask == full_mask else full_mask
+    elif member_index < len(members):
+        mask ^= 1 << member_index
+    user_data[chat_id]["product_assignments"][product_index] = mask
     
-    logger.info(f"Updated assignments for product {product_index}: {user_data[user_id]['product_assignments'][product_index]}")
+    logger.info(f"Updated assignments for product {product_index}: {mask_to_members(mask, members)}")
+    mark_product_changed(context, chat_id, product_index)
     return await show_product_list(update, context)
 
-def parse_qr_data(qr_text):
-    params = {}
-    for part in qr_text.split('&'):
-        if '=' in part:
-            key, value = part.split('=', 1)
-            params[key] = value
-    return params
+def claim_board(session):
+    """Текст и клавиатура доски распределения (групповой режим) для текущей страницы"""
+    products = session["csv_products"]
+    members = session["members"]
+    full_mask = all_members_mask(members)
+    pages = max(1, -(-len(products) // BOARD_PAGE_SIZE))
+    page = min(session["board_page"], pages - 1)
+    first, last = page * BOARD_PAGE_SIZE, min(len(products), (page + 1) * BOARD_PAGE_SIZE)
+    
+    lines = [
+        f"Товары {first + 1}–{last} из {len(products)}. Нажмите на товар, чтобы взять его себе или вернуть, "
+        "«На всех» — чтобы разделить товар между всеми:"
+    ]
+    keyboard = []
+    for i in range(first, last):
+        product = products[i]
+        is_shared = product.get("type") == "shared"
+        if is_shared:
+            claimed = "общий"
+        else:
+            mask = session["product_assignments"].get(i, 0)
+            claimed = (', '.join(mask_to_members(mask, members)) if mask != full_mask else "все") or "никто"
+        lines.append(f"{i + 1}. {product['name'][:50]} - {product['price']:.2f}₽ x {product.get('quantity', 1)}: {claimed}")
+        # Версия товара в callback: по ней отсекаются повторные нажатия по устаревшей доске
+        version = session["product_versions"].get(i, 0)
+        keyboard.append([
+            InlineKeyboardButton(f"{i + 1}. {product['name'][:30]}", callback_data=pack_callback(CB_CLAIM, i, version)),
+            InlineKeyboardButton("По одному" if is_shared else "На всех", callback_data=pack_callback(CB_SHARE, i, version))
+        ])
+    
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("Назад", callback_data=pack_callback(CB_PAGE, page - 1)))
+    if page < pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Далее", callback_data=pack_callback(CB_PAGE, page + 1)))
+    nav_buttons.append(InlineKeyboardButton("Готово", callback_data=pack_callback(CB_DONE)))
+    keyboard.append(nav_buttons)
+    # Товары участников, которые не присоединились к доске, распределяет начавший расчет
+    keyboard.append([InlineKeyboardButton("Распределить по товарам", callback_data=pack_callback(CB_MANUAL))])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
 
-async def get_receipt_from_fns(qr_text):
-    try:
-        payload = {"token": FNS_API_KEY, "qrraw": qr_text}
-        response = requests.post(FNS_API_URL, data=payload)
-        response.raise_for_status()
-        
-        data = response.json()
-        if data.get("code") == 1 and "data" in data and "json" in data["data"] and "document" in data["data"]["json"] and "receipt" in data["data"]["json"]["document"] and "items" in data["data"]["json"]["document"]["receipt"]:
-            items = data["data"]["json"]["document"]["receipt"]["items"]
-            for item in items:
-                if 'price' in item:
-                    item['price'] /= 100.0
-                if 'sum' in item:
-                    item['sum'] /= 100.0
-            return items
+async def show_claim_board(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    session = user_data[chat_id]
+    text, markup = claim_board(session)
+    
+    if update.message:
+        board = await update.message.reply_text(text, reply_markup=markup)
+        members = session["members"]
+        await update.message.reply_text(
+            "Кто вы? Нажмите на свое имя, затем выбирайте свои товары на доске выше.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(member, callback_data=pack_callback(CB_JOIN, i + j)) for j, member in enumerate(members[i:i + 3])]
+                for i in range(0, len(members), 3)
+            ])
+        )
+    else:
+        board = update.callback_query.message
+        await board.edit_text(text, reply_markup=markup)
+    session["board_message"] = (board.chat_id, board.message_id)
+    return CONFIRMING_ASSIGNMENTS
+
+def refresh_board_later(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    """Откладывает перерисовку доски, чтобы одновременные нажатия дали одно редактирование"""
+    session = user_data.get(chat_id)
+    if session is None or session["board_dirty"]:
+        metrics["board.merged_edits"] += 1
+        return
+    session["board_dirty"] = True
+    
+    async def flush():
+        delay = BOARD_EDIT_DELAY
+        while True:
+            # Пока действует RetryAfter, любая перерисовка, в том числе новая, ждет его окончания
+            await asyncio.sleep(max(delay, session["board_retry_at"] - time.monotonic()))
+            if user_data.get(chat_id) is not session or session["board_message"] is None:
+                session["board_dirty"] = False
+                return
+            # Флаг снимается до редактирования: нажатия во время запроса запланируют новое
+            session["board_dirty"] = False
+            text, markup = claim_board(session)
+            board_chat_id, message_id = session["board_message"]
+            try:
+                await context.bot.edit_message_text(text, chat_id=board_chat_id, message_id=message_id, reply_markup=markup)
+                metrics["board.edits"] += 1
+                return
+            except RetryAfter as e:
+                # Лимит Telegram на сообщения в группе: ждем, сколько он просит
+                session["board_retry_at"] = time.monotonic() + e.retry_after
+                delay = BOARD_EDIT_DELAY
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    logger.warning(f"Error updating claim board in chat {chat_id}: {e}")
+                return
+            except TelegramError as e:
+                logger.warning(f"Error updating claim board in chat {chat_id}, retrying: {e}")
+                delay = min(delay * 2, BOARD_MAX_RETRY_DELAY)
+            metrics["board.edit_retries"] += 1
+            # Если за время запроса уже запланирована новая перерисовка, она покажет и эти изменения
+            if session["board_dirty"]:
+                return
+            session["board_dirty"] = True
+    
+    context.application.create_task(flush())
+
+async def join_board(update: Update, context: ContextTypes.DEFAULT_TYPE, member_index):
+    """Связывает пользователя Telegram с участником расчета"""
+    chat_id = update.effective_chat.id
+    session = user_data[chat_id]
+    query = update.callback_query
+    members = session["members"]
+    if member_index >= len(members):
+        await query.answer("Ошибка обработки выбора. Попробуйте снова.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    taken_by = next((user for user, index in session["claimants"].items() if index == member_index), None)
+    if taken_by not in (None, update.effective_user.id):
+        await query.answer(f"{members[member_index]} уже выбран(а) другим пользователем.", show_alert=True)
+        return CONFIRMING_ASSIGNMENTS
+    
+    session["claimants"][update.effective_user.id] = member_index
+    await query.answer(f"Вы — {members[member_index]}. Выбирайте свои товары на доске.")
+    return CONFIRMING_ASSIGNMENTS
+
+async def claim_item(update: Update, context: ContextTypes.DEFAULT_TYPE, product_index, version):
+    """Берет товар себе или возвращает его; нажатия разных участников не конфликтуют"""
+    chat_id = update.effective_chat.id
+    session = user_data[chat_id]
+    query = update.callback_query
+    member_index = session["claimants"].get(update.effective_user.id)
+    if member_index is None:
+        await query.answer("Сначала нажмите на свое имя в сообщении «Кто вы?».", show_alert=True)
+        return CONFIRMING_ASSIGNMENTS
+    
+    if product_index >= len(session["csv_products"]):
+        await query.answer("Ошибка обработки выбора. Попробуйте снова.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    product = session["csv_products"][product_index]
+    if product.get("type") == "shared":
+        await query.answer("Этот товар общий и делится на всех.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    # Оптимистичная версия: если своя отметка участника изменилась после той версии доски,
+    # по которой он нажал, это повторное нажатие — оно уже учтено
+    claim_key = (product_index, member_index)
+    if version < session["claim_versions"].get(claim_key, 0):
+        metrics["board.stale_claims"] += 1
+        await query.answer("Уже учтено.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    mask = session["product_assignments"].get(product_index, 0) ^ (1 << member_index)
+    session["product_assignments"][product_index] = mask
+    session["product_versions"][product_index] = session["product_versions"].get(product_index, 0) + 1
+    session["claim_versions"][claim_key] = session["product_versions"][product_index]
+    logger.info(f"Updated assignments for product {product_index}: {mask_to_members(mask, session['members'])}")
+    
+    await query.answer(f"{'Вы взяли' if mask >> member_index & 1 else 'Вы вернули'}: {product['name'][:50]}")
+    refresh_board_later(context, chat_id)
+    return CONFIRMING_ASSIGNMENTS
+
+async def change_board_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    user_data[update.effective_chat.id]["board_page"] = page
+    return await show_claim_board(update, context)
+
+def mark_product_changed(context: ContextTypes.DEFAULT_TYPE, chat_id, product_index):
+    """Отмечает изменение товара вне доски: старые нажатия по нему станут устаревшими, доска перерисуется"""
+    session = user_data[chat_id]
+    if not session["group"]:
+        return
+    session["product_versions"][product_index] = session["product_versions"].get(product_index, 0) + 1
+    refresh_board_later(context, chat_id)
+
+async def toggle_board_share(update: Update, context: ContextTypes.DEFAULT_TYPE, product_index, version):
+    """Делает товар на доске общим или снова индивидуальным"""
+    chat_id = update.effective_chat.id
+    session = user_data[chat_id]
+    query = update.callback_query
+    if product_index >= len(session["csv_products"]):
+        await query.answer("Ошибка обработки выбора. Попробуйте снова.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    # Переключение не коммутативно: два нажатия по одной версии доски не должны отменить друг друга
+    if version != session["product_versions"].get(product_index, 0):
+        metrics["board.stale_claims"] += 1
+        await query.answer("Товар уже изменился, посмотрите обновленную доску.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    product = session["csv_products"][product_index]
+    product["type"] = "individual" if product.get("type") == "shared" else "shared"
+    session["product_assignments"][product_index] = all_members_mask(session["members"]) if product["type"] == "shared" else 0
+    logger.info(f"Changed product {product_index} to type {product['type']}")
+    
+    await query.answer(f"{'Общий' if product['type'] == 'shared' else 'Индивидуальный'}: {product['name'][:50]}")
+    mark_product_changed(context, chat_id, product_index)
+    return CONFIRMING_ASSIGNMENTS
+
+async def open_manual_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Открывает распределение по товарам с первого товара текущей страницы доски"""
+    session = user_data[update.effective_chat.id]
+    session["current_product_index"] = min(session["board_page"] * BOARD_PAGE_SIZE, len(session["csv_products"]))
+    return await show_product_list(update, context, reply=True)
+
+# Таблица диспетчеризации callback-действий: обработчик и число аргументов
+CALLBACK_HANDLERS = {
+    CB_DONE: (finish_assignments, 0),
+    CB_NEXT: (next_product, 0),
+    CB_PREV: (prev_product, 0),
+    CB_CHANGE_TYPE: (change_product_type, 1),
+    CB_ASSIGN: (toggle_member, 2),
+    CB_ASSIGN_ALL: (toggle_member, 1),
+    CB_CLAIM: (claim_item, 2),
+    CB_JOIN: (join_board, 1),
+    CB_PAGE: (change_board_page, 1),
+    CB_SHARE: (toggle_board_share, 2),
+    CB_MANUAL: (open_manual_assignment, 0),
+}
+
+# Эти обработчики сами отвечают на callback всплывающим уведомлением
+SELF_ANSWERING_CALLBACKS = {CB_CLAIM, CB_JOIN, CB_SHARE}
+
+# В группе распределять по товарам может только начавший расчет
+OWNER_CALLBACKS = {CB_NEXT, CB_PREV, CB_CHANGE_TYPE, CB_ASSIGN, CB_ASSIGN_ALL, CB_MANUAL}
+
+def is_done_callback(data):
+    return unpack_callback(data) == (CB_DONE, [])
+
+def resolve_callback(data, handlers):
+    """Декодирует callback и находит обработчик; (действие, обработчик, аргументы) или None"""
+    decoded = unpack_callback(data)
+    if decoded is None or decoded[0] not in handlers:
         return None
-    except Exception as e:
-        logger.error(f"Error getting receipt from FNS: {e}, Response: {response.text if 'response' in locals() else 'No response'}")
+    action, args = decoded
+    handler, arity = handlers[action]
+    if len(args) != arity:
         return None
+    return action, handler, args
 
-async def decode_qr_from_image(image_path):
+async def handle_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    resolved = resolve_callback(query.data, CALLBACK_HANDLERS)
+    session = user_data.get(chat_id)
+    if session is None:
+        await query.answer()
+        await query.message.reply_text("Сессия устарела. Начните заново командой /start.")
+        return ConversationHandler.END
+    
+    if resolved is None:
+        await query.answer()
+        logger.warning(f"Malformed callback {query.data!r}")
+        await query.message.reply_text("Ошибка обработки выбора. Попробуйте снова.")
+        return CONFIRMING_ASSIGNMENTS
+    
+    action, handler, args = resolved
+    if action in OWNER_CALLBACKS and session["group"] and update.effective_user.id != session["owner"]:
+        await query.answer("Распределять по товарам может только тот, кто начал расчет.", show_alert=True)
+        return CONFIRMING_ASSIGNMENTS
+    if action not in SELF_ANSWERING_CALLBACKS:
+        await query.answer()
+    tag_profile(handler)
+    return await handler(update, context, *args)
+
+def to_kopecks(amount):
+    """Переводит сумму в рублях в целые копейки с округлением до ближайшей копейки"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def create_settlement(chat_id, payer, debts):
+    """Сохраняет долги расчета для выставления счетов, возвращает номер расчета"""
+    settlement_id = next(settlement_ids)
+    settlements[settlement_id] = {
+        "chat_id": chat_id,
+        "payer": payer,
+        "debts": [
+            {"member": member, "kopecks": to_kopecks(amount), "status": "pending", "charge_id": None, "checkout_at": None}
+            for member, amount in debts
+        ]
+    }
+    # Вытесняются старейшие расчеты без выставленных счетов: по ним уже не придет платеж
+    evictable = (sid for sid, settlement in settlements.items() if not has_open_invoices(settlement))
+    for sid in list(itertools.islice(evictable, max(0, len(settlements) - MAX_SETTLEMENTS))):
+        del settlements[sid]
+    return settlement_id
+
+def has_open_invoices(settlement):
+    """Есть ли в расчете счета, по которым еще может прийти платеж"""
+    return any(debt["status"] in ("invoicing", "invoiced", "checking_out") for debt in settlement["debts"])
+
+def find_settlement(query, settlement_id):
+    """Расчет по номеру из кнопки, если он принадлежит чату этой кнопки, иначе None"""
+    settlement = settlements.get(settlement_id)
+    if settlement is None or settlement["chat_id"] != query.message.chat_id:
+        return None
+    return settlement
+
+def invoice_key(settlement_id, debt_index):
+    """Ключ идемпотентности счета, передается как payload инвойса"""
+    return f"debt:{settlement_id}:{debt_index}"
+
+def find_debt(payload):
+    """Находит долг по payload инвойса, возвращает (расчет, долг) или (None, None)"""
+    try:
+        prefix, settlement_id, debt_index = payload.split(':')
+        if prefix != "debt":
+            return None, None
+        settlement = settlements[int(settlement_id)]
+        return settlement, settlement["debts"][int(debt_index)]
+    except (ValueError, KeyError, IndexError):
+        return None, None
+
+async def issue_invoice(bot, settlement_id, debt_index):
+    """Выставляет счет по долгу не более одного раза, возвращает статус долга"""
+    settlement = settlements[settlement_id]
+    debt = settlement["debts"][debt_index]
+    if debt["status"] != "pending":
+        return debt["status"]
+    
+    # Статус меняется до отправки, чтобы повторное нажатие не создало второй счет
+    debt["status"] = "invoicing"
+    member, payer, kopecks = debt["member"], settlement["payer"], debt["kopecks"]
+    try:
+        await bot.send_invoice(
+            chat_id=settlement["chat_id"],
+            title=f"Оплата долга {payer} от {member}",
+            description=f"Оплата долга за покупки: {member} должен {kopecks / 100:.2f}₽ {payer}",
+            payload=invoice_key(settlement_id, debt_index),
+            provider_token=PAYMENT_PROVIDER_TOKEN,
+            currency="RUB",
+            prices=[LabeledPrice(f"Долг {payer}", kopecks)]
+        )
+    except Exception as e:
+        debt["status"] = "pending"
+        logger.error(f"Error sending invoice {invoice_key(settlement_id, debt_index)}: {e}")
+        return "error"
+    
+    debt["status"] = "invoiced"
+    logger.info(f"Sent invoice for {member} to {payer}: {kopecks / 100:.2f}₽")
+    return "invoiced"
+
+async def pay_debt(update: Update, context: ContextTypes.DEFAULT_TYPE, settlement_id, debt_index):
+    query = update.callback_query
+    settlement = find_settlement(query, settlement_id)
+    if settlement is None or debt_index >= len(settlement["debts"]):
+        await query.message.reply_text("Расчет не найден или устарел.")
+        return
+    
+    status = await issue_invoice(context.bot, settlement_id, debt_index)
+    if status == "error":
+        await query.message.reply_text("Ошибка при создании платежа. Проверьте настройки провайдера.")
+    elif status in ("invoicing", "invoiced", "checking_out"):
+        await query.message.reply_text("Счет по этому долгу уже выставлен.")
+    elif status == "paid":
+        await query.message.reply_text("Этот долг уже оплачен.")
+
+async def pay_all_debts(update: Update, context: ContextTypes.DEFAULT_TYPE, settlement_id):
+    """Выставляет счета всем должникам расчета одновременно"""
+    query = update.callback_query
+    settlement = find_settlement(query, settlement_id)
+    if settlement is None:
+        await query.message.reply_text("Расчет не найден или устарел.")
+        return
+    
+    debts = settlement["debts"]
+    statuses = await asyncio.gather(*(
+        issue_invoice(context.bot, settlement_id, i) for i in range(len(debts))
+    ))
+    failed = statuses.count("error")
+    if failed:
+        await query.message.reply_text(f"Не удалось выставить счетов: {failed}. Попробуйте снова.")
+    elif "invoiced" not in statuses:
+        await query.message.reply_text("Все счета уже выставлены.")
+
+# Таблица диспетчеризации callback-действий по оплате: обработчик и число аргументов
+INVOICE_HANDLERS = {
+    CB_PAY: (pay_debt, 2),
+    CB_PAY_ALL: (pay_all_debts, 1),
+}
+
+def is_invoice_callback(data):
+    decoded = unpack_callback(data)
+    return bool(decoded) and decoded[0] in INVOICE_HANDLERS
+
+async def handle_invoice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    resolved = resolve_callback(query.data, INVOICE_HANDLERS)
+    if resolved is None:
+        logger.warning(f"Malformed callback {query.data!r}")
+        await query.message.reply_text("Ошибка обработки выбора. Попробуйте снова.")
+        return
+    
+    _, handler, args = resolved
+    await handler(update, context, *args)
+
+async def pre_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.pre_checkout_query
+    settlement, debt = find_debt(query.invoice_payload)
+    if debt is None:
+        await query.answer(ok=False, error_message="Расчет не найден или устарел.")
+    elif debt["status"] == "paid":
+        await query.answer(ok=False, error_message="Этот долг уже оплачен.")
+    elif debt["status"] == "checking_out" and time.time() - debt["checkout_at"] < CHECKOUT_TIMEOUT:
+        # В группе счет может оплачивать кто угодно: второй одновременный платеж отклоняется
+        await query.answer(ok=False, error_message="Этот долг уже оплачивается. Попробуйте позже.")
+    elif query.currency != "RUB" or query.total_amount != debt["kopecks"]:
+        logger.warning(f"Pre-checkout amount mismatch for {query.invoice_payload}: {query.total_amount} {query.currency}")
+        await query.answer(ok=False, error_message="Сумма платежа не совпадает с долгом.")
+    else:
+        # Резерв снимается сам: если платеж не пришел за CHECKOUT_TIMEOUT, оплату можно начать заново
+        debt["status"] = "checking_out"
+        debt["checkout_at"] = time.time()
+        # Резерв записывается до ответа: иначе после падения можно было бы оплатить долг дважды
+        await save_settlements(context)
+        await query.answer(ok=True)
+
+async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    payment = update.message.successful_payment
+    settlement, debt = find_debt(payment.invoice_payload)
+    if debt is None:
+        logger.error(f"Payment for unknown invoice {payment.invoice_payload}: {payment.telegram_payment_charge_id}")
+        return
+    if debt["status"] == "paid":
+        logger.warning(f"Duplicate payment for {payment.invoice_payload}: {payment.telegram_payment_charge_id}")
+        return
+    
+    debt["status"] = "paid"
+    debt["charge_id"] = payment.telegram_payment_charge_id
+    logger.info(f"Debt {payment.invoice_payload} settled: {debt['kopecks'] / 100:.2f}₽")
+    await save_settlements(context)
+    
+    message = f"{debt['member']} оплатил(а) долг {debt['kopecks'] / 100:.2f}₽ {settlement['payer']}"
+    if all(d["status"] == "paid" for d in settlement["debts"]):
+        message += "\nВсе долги по расчету погашены!"
+    await update.message.reply_text(message)
+
+async def get_receipt_from_fns(qr_text):
+    return await profiled_to_thread(fetch_receipt_items, qr_text)
+
+def decode_qr_from_image(image_path):
     try:
         img = cv2.imread(image_path)
         decoded_objects = decode(img)
@@ -578,21 +1095,29 @@ async def decode_qr_from_image(image_path):
         logger.error(f"Error decoding QR from image: {e}")
         return None
 
+@heavy_operation("qr")
 async def process_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     
+    photo_key = None
+    products = None
     if update.message.photo:
+        photo = update.message.photo[-1]
+        photo_key = f"photo:{photo.file_unique_id}"
+        products = upload_cache.get(photo_key)
+    
+    if products is None and photo_key:
         await update.message.reply_text("Обрабатываю изображение...")
-        photo_file = await update.message.photo[-1].get_file()
+        photo_file = await photo.get_file()
         with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
             await photo_file.download_to_drive(tmp_file.name)
-            qr_text = await decode_qr_from_image(tmp_file.name)
+            qr_text = await profiled_to_thread(decode_qr_from_image, tmp_file.name)
             os.unlink(tmp_file.name)
         
         if not qr_text:
             await update.message.reply_text(
                 "Не удалось распознать QR-код. Попробуйте еще раз или введите данные вручную.",
-                reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+                reply_markup=PRODUCT_MENU
             )
             return ADDING_PRODUCT_NAME
         text = qr_text
@@ -600,51 +1125,53 @@ async def process_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text
     
     try:
-        qr_data = parse_qr_data(text)
-        required_fields = ['t', 's', 'fn', 'i', 'fp']
-        if all(field in qr_data for field in required_fields):
-            await update.message.reply_text("Получаю данные чека...")
-            items = await get_receipt_from_fns(text)
-            if items:
-                user_data[user_id]["csv_products"].extend([
-                    {"name": item['name'], "price": item['price'], "quantity": item.get('quantity', 1), "type": "individual"}
-                    for item in items
-                ])
-                items_list = "\n".join([f"{item['name']} - {item['price']:.2f}₽ x {item.get('quantity', 1)}" for item in items])
-                keyboard = [["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]]
+        if products is None:
+            if not is_valid_qr(text):
                 await update.message.reply_text(
-                    f"Добавлены товары из чека:\n{items_list}\n\n"
-                    "Теперь вы можете распределить их как общие или индивидуальные.",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+                    "Неверный формат QR-кода. Попробуйте еще раз или добавьте товары вручную.",
+                    reply_markup=PRODUCT_MENU
                 )
                 return ADDING_PRODUCT_NAME
-            else:
+            products = upload_cache.get(f"qr:{text}")
+        
+        if products is None:
+            await update.message.reply_text("Получаю данные чека...")
+            items = await get_receipt_from_fns(text)
+            if not items:
                 await update.message.reply_text(
                     "Не удалось получить данные чека. Попробуйте другой QR-код или добавьте товары вручную.",
-                    reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+                    reply_markup=PRODUCT_MENU
                 )
                 return ADDING_PRODUCT_NAME
-        else:
-            await update.message.reply_text(
-                "Неверный формат QR-кода. Попробуйте еще раз или добавьте товары вручную.",
-                reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
-            )
-            return ADDING_PRODUCT_NAME
+            products = products_from_items(items)
+            upload_cache.put(f"qr:{text}", products)
+        if photo_key:
+            upload_cache.put(photo_key, products)
+        
+        user_data[chat_id]["csv_products"].extend(products)
+        items_list = "\n".join([f"{product['name']} - {product['price']:.2f}₽ x {product['quantity']}" for product in products])
+        await update.message.reply_text(
+            f"Добавлены товары из чека:\n{items_list}\n\n"
+            "Теперь вы можете распределить их как общие или индивидуальные.",
+            reply_markup=PRODUCT_MENU
+        )
+        return ADDING_PRODUCT_NAME
     except Exception as e:
         logger.error(f"Error processing QR code: {e}")
         await update.message.reply_text(
             "Ошибка при обработке QR-кода. Попробуйте еще раз или добавьте товары вручную.",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return ADDING_PRODUCT_NAME
 
+@heavy_operation("csv")
 async def process_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     
     if not update.message.document:
         await update.message.reply_text(
             "Пожалуйста, отправьте CSV файл.",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return PROCESSING_CSV
     
@@ -652,10 +1179,17 @@ async def process_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not document.file_name.endswith('.csv'):
         await update.message.reply_text(
             "Файл должен быть в формате CSV. Попробуйте еще раз.",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return PROCESSING_CSV
     
+    # Повторно присланный файл не скачивается и не разбирается заново
+    file_key = f"csv:{document.file_unique_id}"
+    products = upload_cache.get(file_key)
+    if products is not None:
+        user_data[chat_id]["csv_products"] = products
+        return await show_product_list(update, context)
+    
     await update.message.reply_text("Обрабатываю CSV файл...")
     file = await document.get_file()
     tmp_file_path = None
@@ -667,56 +1201,29 @@ async def process_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 lines = f.readlines()
                 logger.info(f"First 5 lines of CSV: {lines[:5]}")
                 
-                header_index = None
-                for i, line in enumerate(lines):
-                    line_clean = line.strip().lower()
-                    if 'товар' in line_clean and 'цена' in line_clean:
-                        header_index = i
-                        break
-                
-                if header_index is None:
-                    logger.error(f"Header row with 'Товар' and 'Цена' not found in CSV")
-                    await update.message.reply_text(
-                        "Не удалось найти заголовки 'Товар' и 'Цена'. Проверьте формат.",
-                        reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
-                    )
-                    return PROCESSING_CSV
-                
-                csv_content = ''.join(lines[header_index:])
-                csv_file = io.StringIO(csv_content)
-                reader = csv.DictReader(csv_file, delimiter=';')
-                
-                required_fields = ['Товар', 'Цена']
-                logger.info(f"Found headers: {reader.fieldnames}")
-                if not all(field in reader.fieldnames for field in required_fields):
-                    await update.message.reply_text(
-                        f"CSV должен содержать колонки 'Товар' и 'Цена'. Найдены: {', '.join(reader.fieldnames or [])}.",
-                        reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
-                    )
+                # Тот же файл мог прийти с другим file_unique_id — ищем по содержимому
+                content_key = f"csv-sha256:{hashlib.sha256(''.join(lines).encode('utf-8')).hexdigest()}"
+                products = upload_cache.get(content_key)
+                try:
+                    if products is None:
+                        products = parse_products_csv(lines)
+                except CsvFormatError as e:
+                    logger.error(f"Invalid CSV: {e}")
+                    if e.fieldnames is None:
+                        text = "Не удалось найти заголовки 'Товар' и 'Цена'. Проверьте формат."
+                    else:
+                        text = f"CSV должен содержать колонки 'Товар' и 'Цена'. Найдены: {', '.join(e.fieldnames)}."
+                    await update.message.reply_text(text, reply_markup=PRODUCT_MENU)
                     return PROCESSING_CSV
                 
-                user_data[user_id]["csv_products"] = []
-                for row in reader:
-                    try:
-                        name = row['Товар'].strip().strip('"')
-                        price = float(row['Цена'].replace(',', '.'))
-                        quantity = float(row.get('Количество', '1').replace(',', '.')) if row.get('Количество') else 1
-                        if not name or price <= 0:
-                            continue
-                        user_data[user_id]["csv_products"].append({
-                            "name": name,
-                            "price": price,
-                            "quantity": quantity,
-                            "type": "individual"
-                        })
-                    except (ValueError, KeyError) as e:
-                        logger.warning(f"Skipping invalid row: {row}, Error: {e}")
-                        continue
-                
-                if not user_data[user_id]["csv_products"]:
+                if products:
+                    upload_cache.put(content_key, products)
+                    upload_cache.put(file_key, products)
+                user_data[chat_id]["csv_products"] = products
+                if not user_data[chat_id]["csv_products"]:
                     await update.message.reply_text(
                         "Не удалось добавить товары из CSV. Проверьте формат данных.",
-                        reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+                        reply_markup=PRODUCT_MENU
                     )
                     return ADDING_PRODUCT_NAME
                 
@@ -726,7 +1233,7 @@ async def process_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error processing CSV: {e}")
         await update.message.reply_text(
             "Ошибка при обработке CSV. Попробуйте еще раз.",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return PROCESSING_CSV
     finally:
@@ -736,80 +1243,128 @@ async def process_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception as e:
                 logger.error(f"Error deleting temp file {tmp_file_path}: {e}")
 
-async def send_long_message(message, text: str, max_length: int = 4000):
-    if len(text) <= max_length:
-        await message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-        return
-    
+def utf16_length(text):
+    """Длина текста в кодовых единицах UTF-16 (так считает лимиты Telegram)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_long_line(line, max_length):
+    """Режет строку длиннее лимита, не разрывая суррогатные пары"""
+    pieces = []
+    start = size = 0
+    for i, char in enumerate(line):
+        width = 2 if ord(char) > 0xFFFF else 1
+        if size + width > max_length:
+            pieces.append(line[start:i])
+            start, size = i, 0
+        size += width
+    pieces.append(line[start:])
+    return pieces
+
+def split_message(text, max_length=TELEGRAM_MESSAGE_LIMIT):
+    """Разбивает текст на части по строкам с учетом длины в UTF-16"""
     parts = []
-    current_part = ""
+    current, current_length = [], 0
     for line in text.split('\n'):
-        if len(current_part) + len(line) + 1 > max_length:
-            parts.append(current_part.strip())
-            current_part = line + '\n'
-        else:
-            current_part += line + '\n'
-    if current_part:
-        parts.append(current_part.strip())
+        line_length = utf16_length(line)
+        pieces = split_long_line(line, max_length) if line_length > max_length else [line]
+        for piece in pieces:
+            piece_length = utf16_length(piece) if len(pieces) > 1 else line_length
+            # +1 за перевод строки перед очередной строкой
+            if current and current_length + 1 + piece_length > max_length:
+                parts.append('\n'.join(current))
+                current, current_length = [], 0
+            current_length += piece_length + (1 if current else 0)
+            current.append(piece)
+    if current:
+        parts.append('\n'.join(current))
+    return [part for part in (p.strip() for p in parts) if part]
+
+async def send_long_message(message, text: str, max_length: int = TELEGRAM_MESSAGE_LIMIT):
+    # Текст отправляется без parse_mode, поэтому сущностей нет и лимит считается по всему тексту
+    parts = split_message(text, max_length)
+    
+    if len(parts) > MAX_MESSAGE_PARTS:
+        # Слишком длинный текст: первая часть сообщением, целиком — файлом
+        await message.reply_text(parts[0])
+        await message.reply_document(
+            document=io.BytesIO(text.encode('utf-8')),
+            filename='receipt_report.txt',
+            caption="Полный отчет",
+            reply_markup=REMOVE_KEYBOARD
+        )
+        return
     
-    for part in parts:
+    # Части отправляются по очереди: параллельная отправка может перемешать их порядок в чате
+    for i, part in enumerate(parts):
         try:
-            await message.reply_text(part, reply_markup=ReplyKeyboardRemove() if part == parts[-1] else None)
+            await message.reply_text(part, reply_markup=REMOVE_KEYBOARD if i == len(parts) - 1 else None)
         except BadRequest as e:
             logger.error(f"Failed to send message part: {e}")
             await message.reply_text(
                 "Ошибка при отправке части сообщения.",
-                reply_markup=ReplyKeyboardRemove()
+                reply_markup=REMOVE_KEYBOARD
             )
 
+def render_expense_chart(debts):
+    """Круговая диаграмма долгов в PNG; Figure без pyplot можно строить в рабочем потоке"""
+    figure = Figure(figsize=(6, 6))
+    axes = figure.subplots()
+    axes.pie([amount for _, amount in debts], labels=[member for member, _ in debts], autopct='%1.1f%%', startangle=90)
+    axes.set_title("Распределение расходов")
+    chart = io.BytesIO()
+    figure.savefig(chart, format='png')
+    chart.seek(0)
+    return chart
+
 async def calculate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     
-    if not user_data[user_id]["receipt"].items and not user_data[user_id]["receipt"].shared_items:
+    if not user_data[chat_id]["receipt"].items and not user_data[chat_id]["receipt"].shared_items:
         message = update.message or update.callback_query.message
         await message.reply_text(
             "Не добавлено ни одного продукта!",
-            reply_markup=ReplyKeyboardMarkup([["Добавить продукт", "Сканировать QR-код", "Загрузить CSV"], ["Завершить расчет"]], one_time_keyboard=True)
+            reply_markup=PRODUCT_MENU
         )
         return ADDING_PRODUCT_NAME
         
     try:
         message = update.message or update.callback_query.message
-        calculation_result, debts = user_data[user_id]["receipt"].calculate(user_data[user_id]["members"])
-        verification_list = user_data[user_id]["receipt"].generate_verification_list(user_data[user_id]["members"])
+        calculation_result, debts = user_data[chat_id]["receipt"].calculate(user_data[chat_id]["members"])
+        verification_list = user_data[chat_id]["receipt"].generate_verification_list(user_data[chat_id]["members"])
         final_message = f"{calculation_result}\n{verification_list}"
         
-        # Генерация круговой диаграммы
+        # Генерация круговой диаграммы в отдельном потоке: отрисовка не должна держать цикл событий
         if debts:
-            labels = [member for member, _ in debts]
-            amounts = [amount for _, amount in debts]
-            plt.figure(figsize=(6, 6))
-            plt.pie(amounts, labels=labels, autopct='%1.1f%%', startangle=90)
-            plt.title("Распределение расходов")
-            chart_path = f"chart_{user_id}.png"
-            plt.savefig(chart_path)
-            plt.close()
-            logger.info(f"Generated expense chart: {chart_path}")
+            chart = await profiled_to_thread(render_expense_chart, debts)
+            logger.info(f"Generated expense chart for chat {chat_id}")
         
         # Отправка сообщения и диаграммы
         await send_long_message(message, final_message)
         if debts:
-            with open(chart_path, 'rb') as f:
-                await message.reply_photo(
-                    photo=f,
-                    caption="Распределение расходов",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-            os.unlink(chart_path)
+            await message.reply_photo(
+                photo=chart,
+                caption="Распределение расходов",
+                reply_markup=REMOVE_KEYBOARD
+            )
         
         # Кнопки для оплаты долгов
-        buttons = [
-            [InlineKeyboardButton(
-                f"Оплатить {user_data[user_id]['receipt'].payer} ({amount:.2f}₽) от {member}",
-                callback_data=f"pay_{member}_{amount:.2f}"
-            )]
-            for member, amount in debts
-        ]
+        buttons = []
+        if debts:
+            settlement_id = create_settlement(message.chat_id, user_data[chat_id]["receipt"].payer, debts)
+            # Номер расчета записывается до появления кнопок: после падения он не будет выдан повторно
+            await save_settlements(context)
+            buttons = [
+                [InlineKeyboardButton(
+                    f"Оплатить {user_data[chat_id]['receipt'].payer} ({debt['kopecks'] / 100:.2f}₽) от {debt['member']}",
+                    callback_data=pack_callback(CB_PAY, settlement_id, i)
+                )]
+                for i, debt in enumerate(settlements[settlement_id]["debts"])
+            ]
+            if len(buttons) > 1:
+                buttons.append([InlineKeyboardButton(
+                    "Выставить счета всем",
+                    callback_data=pack_callback(CB_PAY_ALL, settlement_id)
+                )])
         if buttons:
             await message.reply_text(
                 "Оплатите долг, если хотите:",
@@ -817,7 +1372,7 @@ async def calculate(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         
         # Отправка CSV
-        csv_content = user_data[user_id]["receipt"].generate_verification_csv(user_data[user_id]["members"])
+        csv_content = user_data[chat_id]["receipt"].generate_verification_csv(user_data[chat_id]["members"])
         logger.info(f"CSV content (first 200 chars): {csv_content[:200]}")
         
         with tempfile.NamedTemporaryFile(suffix='.csv', delete=False, mode='w', encoding='utf-8') as tmp_file:
@@ -831,7 +1386,7 @@ async def calculate(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     document=f,
                     filename='receipt_details.csv',
                     caption="Детализация расчета в CSV",
-                    reply_markup=ReplyKeyboardRemove()
+                    reply_markup=REMOVE_KEYBOARD
                 )
         finally:
             os.unlink(tmp_file_path)
@@ -841,33 +1396,278 @@ async def calculate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = update.message or update.callback_query.message
         await message.reply_text(
             "Ошибка: сообщение слишком длинное или содержит некорректные данные.",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     except Exception as e:
         logger.error(f"Error generating or sending CSV/chart: {e}")
         message = update.message or update.callback_query.message
         await message.reply_text(
             "Ошибка при создании или отправке данных.",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     
-    if user_id in user_data:
-        del user_data[user_id]
+    if chat_id in user_data:
+        del user_data[chat_id]
         
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id in user_data:
-        del user_data[user_id]
+    chat_id = update.effective_chat.id
+    if chat_id in user_data:
+        del user_data[chat_id]
         
-    await update.message.reply_text("Отменено", reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text("Отменено", reply_markup=REMOVE_KEYBOARD)
     return ConversationHandler.END
 
-def main():
-    application = Application.builder().token("TOKEN").build()
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [f"{name}: {value}" for name, value in sorted(metrics.items())]
+    lines.append(f"В очереди: {admission.waiting}, пользователей в работе: {len(admission.in_flight)}")
+    for kind, rate in upload_cache.hit_rates().items():
+        lines.append(f"Кэш загрузок {kind}: {rate:.0%} попаданий")
+    await update.message.reply_text("\n".join(lines))
+
+# Состояние диалога текущего обновления и активный профиль; задачи неблокирующих
+# обработчиков и рабочие потоки asyncio.to_thread наследуют их вместе с контекстом
+conversation_state = contextvars.ContextVar("conversation_state", default=None)
+active_profile = contextvars.ContextVar("active_profile", default=None)
+
+class ProfileSample:
+    """Профиль одного обновления: поток цикла событий и работа, вынесенная в рабочие потоки"""
+    # cProfile не допускает двух активных профилей в потоке
+    profiling = False
+    
+    def __init__(self, state_name, handler_name):
+        self.state_name = state_name
+        self.handler_name = handler_name
+        self.profile = cProfile.Profile()
+        self.worker_profiles = []
+
+def profiled(callback):
+    """Оборачивает обработчик диалога: доля вызовов профилируется от начала до конца обработчика"""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if ProfileSample.profiling or random.random() >= PROFILE_SAMPLE_RATE:
+            return await callback(update, context)
+        
+        sample = ProfileSample(conversation_state.get() or "ENTRY", callback.__name__)
+        ProfileSample.profiling = True
+        token = active_profile.set(sample)
+        started = time.perf_counter()
+        sample.profile.enable()
+        try:
+            return await callback(update, context)
+        finally:
+            sample.profile.disable()
+            active_profile.reset(token)
+            ProfileSample.profiling = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            # Запись — фоновой задачей в рабочем потоке: обработчик возвращается, не дожидаясь диска
+            context.application.create_task(asyncio.to_thread(save_profile, sample, elapsed_ms))
+    return wrapper
+
+async def profiled_to_thread(func, *args):
+    """asyncio.to_thread, который при активном профиле профилирует и работу в рабочем потоке"""
+    sample = active_profile.get()
+    if sample is None:
+        return await asyncio.to_thread(func, *args)
+    profile = cProfile.Profile()
+    sample.worker_profiles.append(profile)
+    return await asyncio.to_thread(profile.runcall, func, *args)
+
+def tag_profile(handler):
+    """Подписывает активный профиль настоящим обработчиком, если вызов шел через диспетчер"""
+    sample = active_profile.get()
+    if sample is not None:
+        sample.handler_name = handler.__name__
+
+class ProfiledConversationHandler(ConversationHandler):
+    """ConversationHandler, который профилирует долю обновлений через cProfile.
+    
+    Профилируется сам обработчик, в том числе неблокирующий, который PTB запускает
+    отдельной задачей, и работа, вынесенная им в рабочие потоки через profiled_to_thread.
+    Профили пишутся в PROFILE_DIR с именем <время>--<состояние>--<обработчик>--<мс>ms.prof,
+    старые файлы удаляются сверх PROFILE_MAX_FILES. Сводка: python profile_report.py.
+    cProfile видит весь поток, поэтому в профиль попадают и параллельные обновления;
+    одновременно профилируется только одно обновление.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for handler in itertools.chain(self.entry_points, self.fallbacks, *self.states.values()):
+            handler.callback = profiled(handler.callback)
+    
+    async def handle_update(self, update, application, check_result, context):
+        # check_result: (текущее состояние, ключ диалога, обработчик, результат его проверки)
+        state = check_result[0]
+        token = conversation_state.set(STATE_NAMES.get(state, "ENTRY" if state is None else str(state)))
+        try:
+            return await super().handle_update(update, application, check_result, context)
+        finally:
+            conversation_state.reset(token)
+
+def save_profile(sample, elapsed_ms):
+    """Пишет профиль вместе с профилями рабочих потоков в один файл и удаляет старые"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        # Одно чтение часов: доли секунды отбрасываются, а не округляются, чтобы имена сортировались по времени
+        now = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(now)) + f".{int(now % 1 * 1_000_000):06d}"
+        stats = pstats.Stats(sample.profile)
+        for profile in sample.worker_profiles:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(PROFILE_DIR, f"{stamp}--{sample.state_name}--{sample.handler_name}--{elapsed_ms:.0f}ms.prof"))
+        
+        files = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.prof'))
+        for name in files[:-PROFILE_MAX_FILES]:
+            # Соседняя запись могла удалить этот файл раньше
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(PROFILE_DIR, name))
+    except OSError as e:
+        logger.error(f"Error saving profile: {e}")
+
+def restore_sessions(sessions):
+    """Сбрасывает производные кэши сессий, которые не пишутся в снимок"""
+    # Клавиатуры строятся заново при первом показе: сборка для всех сессий сразу
+    # занимала большую часть загрузки
+    for session in sessions.values():
+        session["keyboards"] = {}
+        session["payer_menu"] = None
+        session["board_dirty"] = False
+        session["board_retry_at"] = 0.0
+    return sessions
+
+def consume_snapshot(path):
+    """Убирает загруженный файл с места, чтобы при следующем запуске он не загрузился повторно"""
+    try:
+        os.replace(path, f"{path}.loaded")
+    except OSError as e:
+        logger.error(f"Error moving loaded snapshot {path}: {e}")
+
+async def save_settlements(context: ContextTypes.DEFAULT_TYPE):
+    persistence = context.application.persistence
+    if isinstance(persistence, SnapshotPersistence):
+        await persistence.save_settlements()
+
+class SnapshotPersistence(BasePersistence):
+    """Сохраняет состояния диалогов и сессии расчетов в файл-снимок, а долги — в отдельный файл.
+    
+    PTB вызывает flush() при остановке, после того как дождется обработки текущих
+    обновлений, — тогда и пишется снимок сессий. Долги пишутся еще и при каждой смене
+    статуса оплаты (save_settlements), чтобы падение бота не вернуло оплаченный долг.
+    При создании оба файла загружаются обратно. Снимок сессий одноразовый — он
+    переименовывается в *.loaded, и после аварийного перезапуска устаревшие сессии не
+    поднимутся снова. Файл долгов всегда актуален и остается на месте.
+    """
+    def __init__(self, path):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False))
+        self.path = path
+        self.settlements_path = f"{path}.settlements"
+        self.settlements_lock = asyncio.Lock()
+        self.conversations = {}
+        self.restore()
+    
+    def restore(self):
+        global settlement_ids
+        started = time.perf_counter()
+        state = read_snapshot(self.path)
+        if state is not None:
+            self.conversations = state["conversations"]
+            # Как и при чтении снимка: без сборщика мусора, который иначе многократно
+            # обходит только что загруженные сессии
+            gc.disable()
+            try:
+                user_data.update(restore_sessions(state["sessions"]))
+            finally:
+                gc.enable()
+            consume_snapshot(self.path)
+            logger.info(f"Restored {len(state['sessions'])} sessions from {self.path} in {time.perf_counter() - started:.2f}s")
+        
+        state = read_snapshot(self.settlements_path)
+        if state is not None:
+            # Файл долгов не одноразовый: он перезаписывается при каждом изменении и
+            # должен пережить повторное падение, иначе номера расчетов начнутся заново
+            settlements.update(state["settlements"])
+            settlement_ids = itertools.count(state["next_settlement_id"])
+            logger.info(f"Restored {len(state['settlements'])} settlements from {self.settlements_path}")
+    
+    async def save_settlements(self):
+        """Записывает долги; вызывается при создании расчета и смене статуса оплаты"""
+        # Копия снимается в цикле событий: запись в потоке не должна видеть долги наполовину измененными
+        state = copy.deepcopy({"settlements": settlements, "next_settlement_id": next(settlement_ids)})
+        async with self.settlements_lock:
+            try:
+                await asyncio.to_thread(write_snapshot, self.settlements_path, state)
+            except OSError as e:
+                logger.error(f"Error writing settlements {self.settlements_path}: {e}")
+    
+    async def flush(self):
+        started = time.perf_counter()
+        state = {
+            "sessions": {
+                chat_id: {key: value for key, value in session.items() if key not in ("keyboards", "payer_menu")}
+                for chat_id, session in user_data.items()
+            },
+            "conversations": self.conversations
+        }
+        await self.save_settlements()
+        try:
+            size = write_snapshot(self.path, state)
+        except OSError as e:
+            logger.error(f"Error writing snapshot {self.path}: {e}")
+            return
+        logger.info(f"Saved {len(user_data)} sessions to {self.path} ({size} bytes) in {time.perf_counter() - started:.2f}s")
+    
+    async def get_conversations(self, name):
+        return self.conversations.get(name, {})
     
-    conv_handler = ConversationHandler(
+    async def update_conversation(self, name, key, new_state):
+        conversation = self.conversations.setdefault(name, {})
+        if new_state is None:
+            conversation.pop(key, None)
+        else:
+            conversation[key] = new_state
+    
+    # Данные user_data/chat_data/bot_data PTB не используются: сессии живут в глобальном user_data
+    async def get_user_data(self):
+        return {}
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_user_data(self, user_id, data):
+        pass
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_user_data(self, user_id):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+def build_conversation_handler():
+    return ProfiledConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
             SELECTING_ACTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_action)],
@@ -876,14 +1676,41 @@ def main():
             ADDING_PRODUCT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_name)],
             ADDING_PRODUCT_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_product_price)],
             SELECTING_PRODUCT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_product_type)],
-            PROCESSING_QR: [MessageHandler(filters.TEXT | filters.PHOTO, process_qr)],
-            PROCESSING_CSV: [MessageHandler(filters.Document.ALL, process_csv)],
-            CONFIRMING_ASSIGNMENTS: [CallbackQueryHandler(handle_assignment)],
+            # Тяжелые обработчики не блокируют остальные обновления; пока они работают,
+            # ConversationHandler держит диалог в ожидании нового состояния
+            PROCESSING_QR: [MessageHandler(filters.TEXT | filters.PHOTO, process_qr, block=False)],
+            PROCESSING_CSV: [MessageHandler(filters.Document.ALL, process_csv, block=False)],
+            CONFIRMING_ASSIGNMENTS: [
+                CallbackQueryHandler(handle_assignment, pattern=is_done_callback, block=False),
+                CallbackQueryHandler(handle_assignment),
+            ],
+            # Без этого состояния обновления чата, пришедшие во время тяжелой операции, молча теряются
+            ConversationHandler.WAITING: [
+                MessageHandler(filters.ALL, busy_reply),
+                CallbackQueryHandler(busy_reply),
+            ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        # Диалог общий на чат: в группе участвуют все
+        per_user=False,
+        name="receipt",
+        persistent=True
+    )
+
+def main():
+    application = (
+        Application.builder()
+        .token("TOKEN")
+        .persistence(SnapshotPersistence(SNAPSHOT_PATH))
+        .build()
     )
     
-    application.add_handler(conv_handler)
+    # Оплата долгов работает и после завершения диалога
+    application.add_handler(CallbackQueryHandler(handle_invoice_callback, pattern=is_invoice_callback))
+    application.add_handler(PreCheckoutQueryHandler(pre_checkout))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(build_conversation_handler())
     application.run_polling()
 
 if __name__ == '__main__':
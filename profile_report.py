@@ -0,0 +1,63 @@
+"""Сводка по профилям обновлений, которые пишет бот при PROFILE_SAMPLE_RATE > 0.
+
+    python profile_report.py profiles/ --state CONFIRMING_ASSIGNMENTS --top 20
+"""
+import argparse
+import os
+import pstats
+
+def load_profiles(directory, state=None, handler=None):
+    """Профили из папки: список (путь, состояние, обработчик, мс) с учетом фильтров"""
+    profiles = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.prof'):
+            continue
+        try:
+            _, profile_state, profile_handler, elapsed = name[:-len('.prof')].split('--')
+            elapsed_ms = float(elapsed[:-len('ms')])
+        except ValueError:
+            continue
+        if (state and profile_state != state) or (handler and profile_handler != handler):
+            continue
+        profiles.append((os.path.join(directory, name), profile_state, profile_handler, elapsed_ms))
+    return profiles
+
+def hottest_functions(paths, sort_key="tottime", top=20):
+    """Объединяет профили и возвращает самые затратные функции: (функция, вызовы, собственное, общее время)"""
+    stats = pstats.Stats(*paths)
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append((f"{function} ({os.path.basename(filename)}:{line})", calls, tottime, cumtime))
+    index = 2 if sort_key == "tottime" else 3
+    rows.sort(key=lambda row: row[index], reverse=True)
+    return rows[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description="Самые горячие функции по сохраненным профилям бота")
+    parser.add_argument("directory", nargs='?', default="profiles", help="папка с профилями (по умолчанию profiles)")
+    parser.add_argument("--state", help="только профили этого состояния диалога")
+    parser.add_argument("--handler", help="только профили этого обработчика")
+    parser.add_argument("--sort", choices=["tottime", "cumtime"], default="tottime", help="сортировка по собственному или общему времени")
+    parser.add_argument("--top", type=int, default=20, help="сколько функций показать")
+    args = parser.parse_args()
+    
+    profiles = load_profiles(args.directory, args.state, args.handler)
+    if not profiles:
+        print("Профили не найдены.")
+        return
+    
+    # Время обновлений по состоянию и обработчику
+    groups = {}
+    for _, state, handler, elapsed_ms in profiles:
+        groups.setdefault((state, handler), []).append(elapsed_ms)
+    print(f"{'Состояние':<28} {'Обработчик':<28} {'N':>5} {'Среднее, мс':>12} {'Макс, мс':>10}")
+    for (state, handler), times in sorted(groups.items(), key=lambda item: -sum(item[1])):
+        print(f"{state:<28} {handler:<28} {len(times):>5} {sum(times) / len(times):>12.1f} {max(times):>10.1f}")
+    
+    print(f"\nСамые горячие функции ({args.sort}, профилей: {len(profiles)}):")
+    print(f"{'Вызовы':>10} {'Собств., с':>11} {'Общее, с':>10}  Функция")
+    for function, calls, tottime, cumtime in hottest_functions([path for path, *_ in profiles], args.sort, args.top):
+        print(f"{calls:>10} {tottime:>11.4f} {cumtime:>10.4f}  {function}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Снимок сессий бота на диск: при остановке бот сохраняет незавершенные расчеты
+и состояния диалогов, при запуске — загружает их обратно.
+
+Замер скорости сохранения и загрузки (загрузка — тем же путем, что и при запуске бота,
+поэтому рядом должен лежать calculator.py со всеми зависимостями):
+    python snapshot.py --benchmark 100000
+"""
+import argparse
+import gc
+import logging
+import os
+import pickle
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+def write_snapshot(path, state):
+    """Атомарно записывает снимок (pickle + zlib), возвращает его размер в байтах"""
+    payload = zlib.compress(pickle.dumps((SNAPSHOT_VERSION, state), protocol=pickle.HIGHEST_PROTOCOL), 1)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(payload)
+
+def read_snapshot(path):
+    """Читает снимок; None, если файла нет или он поврежден либо другой версии"""
+    # Сборщик мусора на время загрузки отключается: миллионы новых объектов
+    # иначе запускают его многократно и замедляют загрузку в разы
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            version, state = pickle.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error, pickle.UnpicklingError, ValueError, TypeError, EOFError) as e:
+        logger.error(f"Error reading snapshot {path}: {e}")
+        return None
+    finally:
+        gc.enable()
+    if version != SNAPSHOT_VERSION:
+        logger.warning(f"Ignoring snapshot {path} of version {version}, expected {SNAPSHOT_VERSION}")
+        return None
+    return state
+
+def benchmark_state(sessions):
+    """Синтетический снимок: сессии как у бота на этапе распределения товаров"""
+    from split_engine import Receipt
+    
+    names = ["Алексей", "Мария", "Иван", "Елена"]
+    state = {"sessions": {}, "conversations": {"receipt": {}}}
+    for chat_id in range(sessions):
+        # У каждой сессии свои объекты, как у бота: общий список pickle записал бы один раз
+        members = [f"{name} {chat_id % 100}" for name in names]
+        receipt = Receipt()
+        receipt.payer = members[chat_id % len(members)]
+        products = [
+            {"name": f"Товар {i} из чека {chat_id}", "price": 10.0 + i, "quantity": 1, "type": "individual" if i % 3 else "shared"}
+            for i in range(10)
+        ]
+        state["sessions"][chat_id] = {
+            "members": members,
+            "receipt": receipt,
+            "current_product": {},
+            "csv_products": products,
+            "product_assignments": {i: (i * 5) % 16 for i in range(10)},
+            "current_product_index": chat_id % 10,
+            "group": False,
+            "claimants": {},
+            "product_versions": {},
+            "claim_versions": {},
+            "board_page": 0,
+            "board_message": None,
+            "board_dirty": False,
+            "board_retry_at": 0.0,
+            "finishing": False
+        }
+        state["conversations"]["receipt"][(chat_id,)] = 9
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер сохранения и загрузки снимка сессий")
+    parser.add_argument("--benchmark", type=int, default=100000, metavar="N", help="число сессий (по умолчанию 100000)")
+    parser.add_argument("--path", default="snapshot_benchmark.bin", help="временный файл снимка")
+    args = parser.parse_args()
+    
+    from calculator import SnapshotPersistence, user_data
+    
+    state = benchmark_state(args.benchmark)
+    started = time.perf_counter()
+    size = write_snapshot(args.path, state)
+    written = time.perf_counter()
+    # Загрузка вместе с восстановлением клавиатур сессий
+    SnapshotPersistence(args.path)
+    loaded = time.perf_counter()
+    os.unlink(f"{args.path}.loaded")
+    
+    assert len(user_data) == args.benchmark
+    print(f"Сессий: {args.benchmark}, размер снимка: {size / 1024 / 1024:.1f} МБ")
+    print(f"Сохранение: {written - started:.2f} с, загрузка: {loaded - written:.2f} с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+"""Расчет общих покупок без Telegram: разбор CSV и QR-чеков, распределение и отчеты.
+
+Тот же движок используется ботом (calculator.py), поэтому результаты бота и
+пакетной обработки совпадают.
+
+Пакетный режим:
+    python split_engine.py receipts/ qr_codes.txt --spec spec.json --output reports/
+
+Файл распределения (spec.json):
+    {
+        "members": ["Алексей", "Мария", "Иван"],
+        "payer": "Иван",
+        "items": {"молоко": ["Алексей", "Мария"]}
+    }
+Ключи "items" ищутся в названии товара без учета регистра; не найденные
+товары считаются общими. Рядом с CSV можно положить одноименный .json —
+он заменяет общий файл распределения для этого чека.
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# API для чека
+FNS_API_URL = "https://proverkacheka.com/api/v1/check/get"
+FNS_API_KEY = os.getenv("FNS_API_KEY", "TOKEN")
+QR_REQUIRED_FIELDS = ['t', 's', 'fn', 'i', 'fp']
+
+class CsvFormatError(ValueError):
+    """CSV без нужных заголовков; fieldnames — найденные колонки или None, если заголовок не найден"""
+    def __init__(self, message, fieldnames=None):
+        super().__init__(message)
+        self.fieldnames = fieldnames
+
+class Receipt:
+    def __init__(self):
+        self.payer = None
+        self.items = []
+        self.shared_items = []
+    
+    def add_item(self, name, price, quantity=1, members=None):
+        if members:
+            self.items.append({"name": name, "price": price, "quantity": quantity, "members": members})
+        else:
+            self.shared_items.append({"name": name, "price": price, "quantity": quantity})
+    
+    def shares(self, members):
+        """Сколько приходится на каждого участника"""
+        calculations = {member: 0 for member in members}
+        
+        # Общие товары
+        for item in self.shared_items:
+            share = (item['price'] * item['quantity']) / len(members)
+            for member in members:
+                calculations[member] += share
+        
+        # Индивидуальные товары
+        for item in self.items:
+            share = (item['price'] * item['quantity']) / len(item['members'])
+            for member in item['members']:
+                calculations[member] += share
+        return calculations
+    
+    def total(self):
+        return sum(item['price'] * item['quantity'] for item in self.shared_items + self.items)
+    
+    def calculate(self, members):
+        calculations = self.shares(members)
+        
+        # Формируем итог
+        result = []
+        result.append(f"Общая сумма: {self.total():.2f}₽")
+        result.append(f"Оплатил(а): {self.payer}")
+        
+        debts = []
+        for member, amount in calculations.items():
+            if member != self.payer and amount > 0:
+                debts.append((member, amount))
+                result.append(f"{member} должен {amount:.2f}₽ {self.payer}")
+        
+        return "\n".join(result), debts
+    
+    def generate_verification_list(self, members):
+        """Генерирует список для сверки: кто за что платит"""
+        def truncate_name(name, max_length=50):
+            """Обрезает длинные названия продуктов"""
+            return name[:max_length] + "..." if len(name) > max_length else name
+        
+        result = ["\n--- Список для сверки ---"]
+        
+        # Общие товары
+        if self.shared_items:
+            result.append("Общие товары (делятся на всех):")
+            for item in self.shared_items:
+                result.append(
+                    f"- {truncate_name(item['name'])}: {item['price']:.2f}₽ x {item['quantity']} "
+                    f"(все участники: {', '.join(members)})"
+                )
+        
+        # Индивидуальные товары
+        if self.items:
+            result.append("Индивидуальные товары:")
+            for item in self.items:
+                result.append(
+                    f"- {truncate_name(item['name'])}: {item['price']:.2f}₽ x {item['quantity']} "
+                    f"(участники: {', '.join(item['members'])})"
+                )
+        
+        if not self.shared_items and not self.items:
+            result.append("Нет товаров для сверки.")
+        
+        return "\n".join(result)
+    
+    def generate_verification_csv(self, members):
+        """Генерирует CSV с детализацией товаров, участников и итогами"""
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=';', lineterminator='\n')
+        writer.writerow(['Тип', 'Товар', 'Цена', 'Количество', 'Участники'])
+        
+        # Общие товары
+        for item in self.shared_items:
+            writer.writerow([
+                'Общий',
+                item['name'],
+                f"{item['price']:.2f}",
+                item['quantity'],
+                ', '.join(members)
+            ])
+        
+        # Индивидуальные товары
+        for item in self.items:
+            writer.writerow([
+                'Индивидуальный',
+                item['name'],
+                f"{item['price']:.2f}",
+                item['quantity'],
+                ', '.join(item['members'])
+            ])
+        
+        # Добавляем итоги
+        writer.writerow([])  # Пустая строка для разделения
+        writer.writerow([f"Общая сумма: {self.total():.2f}₽"])
+        writer.writerow([f"Оплатил(а): {self.payer}"])
+        for member, amount in self.shares(members).items():
+            if member != self.payer:
+                writer.writerow([f"{member} должен {amount:.2f}₽ {self.payer}"])
+        
+        csv_content = output.getvalue()
+        output.close()
+        return csv_content
+
+def parse_qr_data(qr_text):
+    params = {}
+    for part in qr_text.split('&'):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            params[key] = value
+    return params
+
+def is_valid_qr(qr_text):
+    qr_data = parse_qr_data(qr_text)
+    return all(field in qr_data for field in QR_REQUIRED_FIELDS)
+
+def fetch_receipt_items(qr_text):
+    """Запрашивает товары чека по строке QR-кода; цены в рублях. None при ошибке"""
+    try:
+        payload = {"token": FNS_API_KEY, "qrraw": qr_text}
+        response = requests.post(FNS_API_URL, data=payload)
+        response.raise_for_status()
+        
+        data = response.json()
+        if data.get("code") == 1 and "data" in data and "json" in data["data"] and "document" in data["data"]["json"] and "receipt" in data["data"]["json"]["document"] and "items" in data["data"]["json"]["document"]["receipt"]:
+            items = data["data"]["json"]["document"]["receipt"]["items"]
+            for item in items:
+                if 'price' in item:
+                    item['price'] /= 100.0
+                if 'sum' in item:
+                    item['sum'] /= 100.0
+            return items
+        return None
+    except Exception as e:
+        logger.error(f"Error getting receipt from FNS: {e}, Response: {response.text if 'response' in locals() else 'No response'}")
+        return None
+
+def products_from_items(items):
+    """Товары чека ФНС в формате продуктов бота"""
+    return [
+        {"name": item['name'], "price": item['price'], "quantity": item.get('quantity', 1), "type": "individual"}
+        for item in items
+    ]
+
+def parse_products_csv(lines):
+    """Разбирает строки CSV (Товар;Цена;Количество) в список продуктов.
+    
+    Строки до заголовка пропускаются, некорректные строки товаров — тоже.
+    Бросает CsvFormatError, если заголовок или обязательные колонки не найдены.
+    """
+    header_index = None
+    for i, line in enumerate(lines):
+        line_clean = line.strip().lower()
+        if 'товар' in line_clean and 'цена' in line_clean:
+            header_index = i
+            break
+    
+    if header_index is None:
+        raise CsvFormatError("Header row with 'Товар' and 'Цена' not found in CSV")
+    
+    reader = csv.DictReader(io.StringIO(''.join(lines[header_index:])), delimiter=';')
+    
+    required_fields = ['Товар', 'Цена']
+    logger.info(f"Found headers: {reader.fieldnames}")
+    if not all(field in reader.fieldnames for field in required_fields):
+        raise CsvFormatError(f"Missing required columns, found: {reader.fieldnames}", reader.fieldnames or [])
+    
+    products = []
+    for row in reader:
+        try:
+            name = row['Товар'].strip().strip('"')
+            price = float(row['Цена'].replace(',', '.'))
+            quantity = float(row.get('Количество', '1').replace(',', '.')) if row.get('Количество') else 1
+            if not name or price <= 0:
+                continue
+            products.append({
+                "name": name,
+                "price": price,
+                "quantity": quantity,
+                "type": "individual"
+            })
+        except (ValueError, KeyError, AttributeError) as e:
+            logger.warning(f"Skipping invalid row: {row}, Error: {e}")
+            continue
+    return products
+
+def load_spec(path):
+    """Читает и проверяет файл распределения; ValueError, если структура неверна"""
+    with open(path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    validate_spec(spec, path)
+    return spec
+
+def validate_spec(spec, source="spec"):
+    if not isinstance(spec, dict):
+        raise ValueError(f"{source}: spec must be a JSON object")
+    members = spec.get("members")
+    if not isinstance(members, list) or not members or not all(isinstance(member, str) for member in members):
+        raise ValueError(f"{source}: 'members' must be a non-empty list of names")
+    if spec.get("payer") not in members:
+        raise ValueError(f"{source}: 'payer' must be one of the members")
+    items = spec.get("items", {})
+    if not isinstance(items, dict) or not all(
+        isinstance(key, str) and isinstance(value, list) and all(isinstance(member, str) for member in value)
+        for key, value in items.items()
+    ):
+        raise ValueError(f"{source}: 'items' must map product names to lists of members")
+
+def split_receipt(products, spec):
+    """Распределяет продукты по файлу распределения и возвращает Receipt"""
+    members = spec["members"]
+    rules = [(key.lower(), value) for key, value in spec.get("items", {}).items()]
+    receipt = Receipt()
+    receipt.payer = spec["payer"]
+    for product in products:
+        name = product["name"].lower()
+        assigned = next((value for key, value in rules if key in name), None)
+        if assigned and set(assigned) - set(members):
+            raise ValueError(f"Unknown members for '{product['name']}': {sorted(set(assigned) - set(members))}")
+        receipt.add_item(
+            product["name"],
+            product["price"],
+            product.get("quantity", 1),
+            assigned if assigned and set(assigned) != set(members) else None
+        )
+    return receipt
+
+def collect_sources(inputs):
+    """Разворачивает пути в список чеков: (имя, "csv", путь) или (имя, "qr", строка QR)"""
+    sources = []
+    for path in inputs:
+        paths = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(('.csv', '.txt'))
+        ) if os.path.isdir(path) else [path]
+        for file_path in paths:
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            if file_path.endswith('.csv'):
+                sources.append((stem, "csv", file_path))
+                continue
+            # В .txt каждая непустая строка — отдельный QR-код
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    if line.strip():
+                        sources.append((f"{stem}_{line_number}", "qr", line.strip()))
+    return sources
+
+def process_source(source, spec, output_dir):
+    """Обрабатывает один чек и пишет отчет; выполняется в отдельном процессе"""
+    name, kind, value = source
+    try:
+        if kind == "csv":
+            sidecar = os.path.splitext(value)[0] + '.json'
+            if os.path.exists(sidecar):
+                spec = load_spec(sidecar)
+            with open(value, 'r', encoding='utf-8-sig') as f:
+                products = parse_products_csv(f.readlines())
+        else:
+            if not is_valid_qr(value):
+                raise ValueError("invalid QR string")
+            items = fetch_receipt_items(value)
+            if not items:
+                raise ValueError("receipt not found in FNS")
+            products = products_from_items(items)
+        if not products:
+            raise ValueError("no products")
+        
+        receipt = split_receipt(products, spec)
+        with open(os.path.join(output_dir, f"{name}_settlement.csv"), 'w', encoding='utf-8') as f:
+            f.write('\ufeff')
+            f.write(receipt.generate_verification_csv(spec["members"]))
+        _, debts = receipt.calculate(spec["members"])
+        return {"name": name, "payer": receipt.payer, "total": receipt.total(), "debts": debts, "error": None}
+    except (OSError, ValueError) as e:
+        return {"name": name, "payer": None, "total": 0, "debts": [], "error": str(e)}
+
+def run_batch(inputs, spec, output_dir, workers=None):
+    """Обрабатывает все чеки в пуле процессов и пишет сводный отчет summary.csv"""
+    os.makedirs(output_dir, exist_ok=True)
+    sources = collect_sources(inputs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            process_source, sources, [spec] * len(sources), [output_dir] * len(sources),
+            chunksize=max(1, len(sources) // ((workers or os.cpu_count() or 1) * 4))
+        ))
+    
+    # Долги складываются по паре (должник, плательщик)
+    totals = {}
+    for result in results:
+        for member, amount in result["debts"]:
+            totals[(member, result["payer"])] = totals.get((member, result["payer"]), 0) + amount
+    
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', encoding='utf-8', newline='') as f:
+        f.write('\ufeff')
+        writer = csv.writer(f, delimiter=';', lineterminator='\n')
+        writer.writerow(['Чек', 'Общая сумма', 'Ошибка'])
+        for result in results:
+            writer.writerow([result["name"], f"{result['total']:.2f}", result["error"] or ''])
+        writer.writerow([])
+        writer.writerow(['Должник', 'Кому', 'Сумма'])
+        for (member, payer), amount in sorted(totals.items()):
+            writer.writerow([member, payer, f"{amount:.2f}"])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетный расчет общих покупок по CSV и QR-чекам")
+    parser.add_argument("inputs", nargs='+', help="CSV-файлы, .txt со строками QR-кодов или папки с ними")
+    parser.add_argument("--spec", required=True, help="JSON с участниками, плательщиком и распределением товаров")
+    parser.add_argument("--output", default="reports", help="папка для отчетов (по умолчанию reports)")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов (по умолчанию по числу ядер)")
+    args = parser.parse_args()
+    
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    results = run_batch(args.inputs, load_spec(args.spec), args.output, args.workers)
+    failed = [result for result in results if result["error"]]
+    for result in failed:
+        logger.error(f"{result['name']}: {result['error']}")
+    logger.info(f"Processed {len(results) - len(failed)} of {len(results)} receipts, reports in {args.output}")
+
+if __name__ == '__main__':
+    main()
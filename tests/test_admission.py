@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import ConversationHandler
+
+import calculator
+from calculator import AdmissionControl, build_conversation_handler, busy_reply, render_expense_chart
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(calculator, "metrics", calculator.Counter())
+
+def test_admission_rejects_second_operation_of_same_user():
+    admission = AdmissionControl(per_user_limit=1, heavy_limit=2, queue_limit=1)
+    
+    async def scenario():
+        async with admission.admit(1, "qr") as first:
+            async with admission.admit(1, "qr") as second, admission.admit(2, "qr") as other:
+                return first, second, other
+    
+    assert asyncio.run(scenario()) == (True, False, True)
+    assert calculator.metrics["qr.rejected_user"] == 1
+    assert admission.in_flight == {}
+
+def test_admission_queues_then_rejects_when_queue_is_full():
+    admission = AdmissionControl(per_user_limit=1, heavy_limit=1, queue_limit=1)
+    
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def hold(user_id):
+            async with admission.admit(user_id, "csv") as admitted:
+                await release.wait()
+                return admitted
+        
+        holder = asyncio.create_task(hold(1))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(hold(2))
+        await asyncio.sleep(0)
+        async with admission.admit(3, "csv") as rejected:
+            pass
+        release.set()
+        return await holder, await queued, rejected
+    
+    assert asyncio.run(scenario()) == (True, True, False)
+    assert calculator.metrics["csv.queued"] == 1
+    assert calculator.metrics["csv.rejected_busy"] == 1
+
+def test_updates_while_heavy_handler_runs_get_busy_reply():
+    conversation = build_conversation_handler()
+    handlers = conversation.states[ConversationHandler.WAITING]
+    message = Message(1, datetime.now(), Chat(1, Chat.PRIVATE), from_user=User(1, "Иван", False), text="еще фото")
+    update = Update(1, message=message)
+    
+    assert any(handler.check_update(update) for handler in handlers)
+    
+    message.set_bot(AsyncMock())
+    message.get_bot().send_message.return_value = message
+    asyncio.run(busy_reply(update, None))
+    message.get_bot().send_message.assert_awaited_once()
+    assert calculator.metrics["waiting.rejected_user"] == 1
+
+def test_expense_chart_renders_png():
+    assert render_expense_chart([("Мария", 10.0), ("Елена", 30.0)]).read(8) == b"\x89PNG\r\n\x1a\n"
@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+import calculator
+from calculator import (
+    CB_ASSIGN, CB_DONE, CB_PAY, CALLBACK_HANDLERS, CONFIRMING_ASSIGNMENTS, handle_assignment, pack_callback,
+    resolve_callback, unpack_callback
+)
+
+def test_callback_round_trip_fits_telegram_limit():
+    data = pack_callback(CB_PAY, 123456789, 44)
+    assert len(data.encode("ascii")) <= 64
+    assert unpack_callback(data) == (CB_PAY, [123456789, 44])
+
+@pytest.mark.parametrize("data", ["done_assignments", "!!", "", pack_callback(CB_DONE)[:-1] + "?"])
+def test_unpack_callback_rejects_garbage(data):
+    assert unpack_callback(data) is None
+
+def test_resolve_callback_checks_arity():
+    assert resolve_callback(pack_callback(CB_ASSIGN, 1), CALLBACK_HANDLERS) is None
+    action, _, args = resolve_callback(pack_callback(CB_ASSIGN, 1, 2), CALLBACK_HANDLERS)
+    assert (action, args) == (CB_ASSIGN, [1, 2])
+
+def test_malformed_callback_is_answered_without_dispatch(monkeypatch):
+    monkeypatch.setattr(calculator, "user_data", {1: {"group": False}})
+    query = SimpleNamespace(data=pack_callback(CB_ASSIGN, 1), answer=AsyncMock(), message=SimpleNamespace(reply_text=AsyncMock()))
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1), effective_user=SimpleNamespace(id=1), callback_query=query)
+    
+    assert asyncio.run(handle_assignment(update, None)) == CONFIRMING_ASSIGNMENTS
+    query.answer.assert_awaited_once()
+    query.message.reply_text.assert_awaited_once_with("Ошибка обработки выбора. Попробуйте снова.")
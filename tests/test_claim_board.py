@@ -0,0 +1,103 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+from telegram.error import RetryAfter
+
+import calculator
+from calculator import refresh_board_later, start
+
+CHAT_ID = -100
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(calculator, "user_data", {})
+    monkeypatch.setattr(calculator, "metrics", calculator.Counter())
+    monkeypatch.setattr(calculator, "BOARD_EDIT_DELAY", 0.01)
+
+def group_update(user_id=1, callback_query=None):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=CHAT_ID, type="group"),
+        effective_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(reply_text=AsyncMock()),
+        callback_query=callback_query
+    )
+
+def group_session():
+    asyncio.run(start(group_update(), None))
+    session = calculator.user_data[CHAT_ID]
+    session["members"] = ["Алексей", "Мария", "Иван"]
+    session["csv_products"] = [{"name": "Хлеб", "price": 50.0, "quantity": 1, "type": "individual"}]
+    session["board_message"] = (CHAT_ID, 7)
+    return session
+
+def test_new_refresh_waits_for_retry_after_of_failed_edit():
+    session = group_session()
+    
+    async def scenario():
+        tasks, edits = [], []
+        context = SimpleNamespace(
+            bot=SimpleNamespace(edit_message_text=AsyncMock()),
+            application=SimpleNamespace(create_task=lambda coroutine: tasks.append(asyncio.ensure_future(coroutine)))
+        )
+        
+        async def edit(*args, **kwargs):
+            edits.append(time.monotonic())
+            if len(edits) == 1:
+                # Нажатие во время неудачного редактирования планирует новую перерисовку
+                refresh_board_later(context, CHAT_ID)
+                raise RetryAfter(0.2)
+        
+        context.bot.edit_message_text.side_effect = edit
+        refresh_board_later(context, CHAT_ID)
+        while not all(task.done() for task in tasks):
+            await asyncio.gather(*tasks)
+        return edits
+    
+    first, second = asyncio.run(scenario())
+    assert second - first >= 0.2
+    assert not session["board_dirty"]
+
+def tap(session, user_id, action, *args):
+    query = SimpleNamespace(answer=AsyncMock())
+    context = SimpleNamespace(application=SimpleNamespace(create_task=lambda coroutine: coroutine.close()))
+    asyncio.run(action(group_update(user_id, query), context, *args))
+    return query.answer.await_args.args[0]
+
+def test_repeated_tap_on_stale_board_is_counted_once():
+    session = group_session()
+    tap(session, 1, calculator.join_board, 0)
+    tap(session, 2, calculator.join_board, 1)
+    
+    # Оба нажали по доске версии 0, Алексей — дважды, пока доска не перерисовалась
+    tap(session, 1, calculator.claim_item, 0, 0)
+    assert tap(session, 1, calculator.claim_item, 0, 0) == "Уже учтено."
+    tap(session, 2, calculator.claim_item, 0, 0)
+    
+    assert session["product_assignments"][0] == 0b011
+    assert calculator.metrics["board.stale_claims"] == 1
+    
+    # По свежей доске повторное нажатие возвращает товар
+    tap(session, 1, calculator.claim_item, 0, session["product_versions"][0])
+    assert session["product_assignments"][0] == 0b010
+
+def test_claim_requires_joining_first():
+    session = group_session()
+    assert tap(session, 3, calculator.claim_item, 0, 0).startswith("Сначала нажмите на свое имя")
+    assert session["product_assignments"] == {}
+
+def test_share_toggle_rejects_stale_version():
+    session = group_session()
+    tap(session, 1, calculator.toggle_board_share, 0, 0)
+    assert session["csv_products"][0]["type"] == "shared"
+    assert session["product_assignments"][0] == 0b111
+    
+    # Второй участник нажал «На всех» по той же версии доски — переключение не отменяется
+    tap(session, 2, calculator.toggle_board_share, 0, 0)
+    assert session["csv_products"][0]["type"] == "shared"
@@ -0,0 +1,25 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+from calculator import MAX_MESSAGE_PARTS, send_long_message, split_message, utf16_length
+
+def test_split_message_respects_utf16_limit():
+    text = "a" * 10 + "\n" + "😀" * 7 + "\nbc\n" + "x" * 25
+    parts = split_message(text, 8)
+    assert all(utf16_length(part) <= 8 for part in parts)
+    assert "".join(part.replace("\n", "") for part in parts) == text.replace("\n", "")
+
+def test_long_report_is_sent_as_file():
+    message = SimpleNamespace(reply_text=AsyncMock(), reply_document=AsyncMock())
+    text = "\n".join(["x" * 10] * (MAX_MESSAGE_PARTS + 1))
+    
+    asyncio.run(send_long_message(message, text, max_length=10))
+    
+    message.reply_text.assert_awaited_once_with("x" * 10)
+    assert message.reply_document.await_args.kwargs["document"].getvalue() == text.encode("utf-8")
@@ -0,0 +1,41 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+import calculator
+from calculator import conversation_state, profiled, profiled_to_thread, tag_profile
+from profile_report import hottest_functions, load_profiles
+
+def decode_in_worker():
+    time.sleep(0.01)
+    return "qr"
+
+async def dispatched_target(update, context):
+    return await profiled_to_thread(decode_in_worker)
+
+async def dispatcher(update, context):
+    tag_profile(dispatched_target)
+    return await dispatched_target(update, context)
+
+def test_profile_covers_handler_and_worker_thread(tmp_path, monkeypatch):
+    monkeypatch.setattr(calculator, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(calculator, "PROFILE_DIR", str(tmp_path))
+    
+    async def scenario():
+        saves = []
+        context = SimpleNamespace(application=SimpleNamespace(create_task=lambda coroutine: saves.append(asyncio.ensure_future(coroutine))))
+        conversation_state.set("PROCESSING_QR")
+        result = await profiled(dispatcher)(None, context)
+        await asyncio.gather(*saves)
+        return result
+    
+    assert asyncio.run(scenario()) == "qr"
+    [(path, state, handler, elapsed_ms)] = load_profiles(str(tmp_path))
+    assert (state, handler) == ("PROCESSING_QR", "dispatched_target")
+    assert elapsed_ms >= 10
+    assert any(function.startswith("decode_in_worker ") for function, *_ in hottest_functions([path], top=100))
@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+import calculator
+from calculator import create_settlement, pay_all_debts, pay_debt, to_kopecks
+
+@pytest.fixture(autouse=True)
+def fresh_settlements(monkeypatch):
+    monkeypatch.setattr(calculator, "settlements", {})
+
+def callback_update(chat_id):
+    message = SimpleNamespace(chat_id=chat_id, reply_text=AsyncMock())
+    return SimpleNamespace(callback_query=SimpleNamespace(message=message))
+
+@pytest.mark.parametrize("amount, kopecks", [(80.625, 8063), (0.1 + 0.2, 30), (40.3125, 4031), (100, 10000)])
+def test_to_kopecks_rounds_half_up(amount, kopecks):
+    assert to_kopecks(amount) == kopecks
+
+def test_eviction_keeps_settlements_with_open_invoices(monkeypatch):
+    monkeypatch.setattr(calculator, "MAX_SETTLEMENTS", 2)
+    invoiced = create_settlement(1, "Иван", [("Мария", 10)])
+    calculator.settlements[invoiced]["debts"][0]["status"] = "invoiced"
+    pending = create_settlement(1, "Иван", [("Мария", 20)])
+    latest = create_settlement(1, "Иван", [("Мария", 30)])
+    
+    assert list(calculator.settlements) == [invoiced, latest]
+    assert pending not in calculator.settlements
+
+def test_pay_buttons_reject_settlement_of_another_chat():
+    settlement_id = create_settlement(1, "Иван", [("Мария", 10), ("Елена", 20)])
+    context = SimpleNamespace(bot=SimpleNamespace(send_invoice=AsyncMock()))
+    
+    update = callback_update(chat_id=2)
+    asyncio.run(pay_debt(update, context, settlement_id, 0))
+    asyncio.run(pay_all_debts(update, context, settlement_id))
+    
+    context.bot.send_invoice.assert_not_awaited()
+    assert update.callback_query.message.reply_text.await_count == 2
+    assert all(debt["status"] == "pending" for debt in calculator.settlements[settlement_id]["debts"])
@@ -0,0 +1,57 @@
+import asyncio
+import itertools
+import os
+
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+from telegram import ReplyKeyboardMarkup
+
+import calculator
+from calculator import SnapshotPersistence, create_settlement
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(calculator, "user_data", {})
+    monkeypatch.setattr(calculator, "settlements", {})
+    monkeypatch.setattr(calculator, "settlement_ids", itertools.count(1))
+
+def restart(monkeypatch, path):
+    monkeypatch.setattr(calculator, "user_data", {})
+    monkeypatch.setattr(calculator, "settlements", {})
+    monkeypatch.setattr(calculator, "settlement_ids", itertools.count(1))
+    return SnapshotPersistence(path)
+
+def test_sessions_restore_once_and_settlements_survive_crashes(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.snapshot")
+    persistence = SnapshotPersistence(path)
+    calculator.user_data[42] = {"members": ["Мария", "Иван"], "keyboards": {"cached": object()}, "payer_menu": None, "board_dirty": True}
+    asyncio.run(persistence.update_conversation("receipt", (42,), calculator.CONFIRMING_ASSIGNMENTS))
+    settlement_id = create_settlement(42, "Иван", [("Мария", 10.5)])
+    calculator.settlements[settlement_id]["debts"][0]["status"] = "paid"
+    asyncio.run(persistence.flush())
+    
+    persistence = restart(monkeypatch, path)
+    session = calculator.user_data[42]
+    assert session["keyboards"] == {} and not session["board_dirty"]
+    assert isinstance(calculator.payer_menu(session), ReplyKeyboardMarkup)
+    assert asyncio.run(persistence.get_conversations("receipt")) == {(42,): calculator.CONFIRMING_ASSIGNMENTS}
+    assert not os.path.exists(path) and os.path.exists(f"{path}.loaded")
+    
+    # Падение сразу после перезапуска: сессии не поднимаются повторно, долги и счетчик — на месте
+    restart(monkeypatch, path)
+    assert calculator.user_data == {}
+    assert calculator.settlements[settlement_id]["debts"][0]["status"] == "paid"
+    assert create_settlement(42, "Иван", [("Мария", 1)]) > settlement_id
+
+def test_payment_status_is_written_without_shutdown(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.snapshot")
+    persistence = SnapshotPersistence(path)
+    settlement_id = create_settlement(42, "Иван", [("Мария", 10.5)])
+    calculator.settlements[settlement_id]["debts"][0]["status"] = "paid"
+    asyncio.run(persistence.save_settlements())
+    
+    restart(monkeypatch, path)
+    assert calculator.settlements[settlement_id]["debts"][0]["status"] == "paid"
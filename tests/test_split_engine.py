@@ -0,0 +1,69 @@
+import csv
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+from split_engine import load_spec, parse_products_csv, run_batch
+
+SPEC = {
+    "members": ["Алексей", "Мария", "Иван", "Елена"],
+    "payer": "Иван",
+    "items": {"молоко": ["Алексей", "Мария"]}
+}
+
+def write_csv(path, rows):
+    path.write_text("Товар;Цена;Количество\n" + "".join(f"{row}\n" for row in rows), encoding="utf-8")
+
+def read_report(path):
+    with open(path, encoding="utf-8-sig") as f:
+        return list(csv.reader(f, delimiter=';'))
+
+def test_parse_products_csv_skips_invalid_rows():
+    products = parse_products_csv(["Дата;;\n", "Товар;Цена;Количество\n", "Хлеб;100,50;2\n", "Плохо;abc;1\n"])
+    assert products == [{"name": "Хлеб", "price": 100.5, "quantity": 2.0, "type": "individual"}]
+
+def test_run_batch_round_trip(tmp_path):
+    inputs, output = tmp_path / "in", tmp_path / "out"
+    inputs.mkdir()
+    write_csv(inputs / "r1.csv", ["Хлеб;100,50;1", "Молоко;60,75;1"])
+    write_csv(inputs / "r2.csv", ["Хлеб;100,50;1", "Молоко;60,75;1"])
+    # Файл рядом с CSV заменяет общее распределение: здесь все товары общие
+    (inputs / "r2.json").write_text(json.dumps({"members": SPEC["members"], "payer": "Иван"}), encoding="utf-8")
+    
+    results = run_batch([str(inputs)], SPEC, str(output), workers=2)
+    
+    assert [result["error"] for result in results] == [None, None]
+    debts = {result["name"]: dict(result["debts"]) for result in results}
+    assert debts["r1"]["Алексей"] == pytest.approx(100.5 / 4 + 60.75 / 2)
+    assert debts["r2"]["Алексей"] == pytest.approx(161.25 / 4)
+    assert ["Индивидуальный", "Молоко", "60.75", "1.0", "Алексей, Мария"] in read_report(output / "r1_settlement.csv")
+    
+    summary = read_report(output / "summary.csv")
+    assert ["Алексей", "Иван", f"{100.5 / 4 + 60.75 / 2 + 161.25 / 4:.2f}"] in summary
+    assert not any(row[:1] == ["Иван"] and row[1:2] == ["Иван"] for row in summary)
+
+@pytest.mark.parametrize("sidecar", [
+    [1, 2, 3],
+    {"members": ["Алексей", "Иван"], "payer": "Иван", "items": ["молоко"]},
+    {"members": ["Алексей", "Иван"], "payer": "Мария"},
+])
+def test_run_batch_records_bad_sidecar(tmp_path, sidecar):
+    inputs, output = tmp_path / "in", tmp_path / "out"
+    inputs.mkdir()
+    write_csv(inputs / "good.csv", ["Хлеб;100;1"])
+    write_csv(inputs / "bad.csv", ["Хлеб;100;1"])
+    (inputs / "bad.json").write_text(json.dumps(sidecar), encoding="utf-8")
+    
+    results = {result["name"]: result for result in run_batch([str(inputs)], SPEC, str(output), workers=1)}
+    
+    assert results["good"]["error"] is None
+    assert results["bad"]["error"]
+    assert (output / "summary.csv").exists()
+
+def test_load_spec_rejects_wrong_shape(tmp_path):
+    path = tmp_path / "spec.json"
+    path.write_text(json.dumps({"members": "Иван", "payer": "Иван"}), encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_spec(str(path))
@@ -0,0 +1,31 @@
+import pytest
+
+for module in ("telegram", "cv2", "pyzbar.pyzbar", "matplotlib"):
+    pytest.importorskip(module)
+
+import calculator
+from calculator import UploadCache
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(calculator, "metrics", calculator.Counter())
+
+def test_cache_evicts_least_recently_used():
+    cache = UploadCache(max_size=2)
+    cache.put("photo:a", [{"name": "Хлеб"}])
+    cache.put("photo:b", [{"name": "Молоко"}])
+    cache.get("photo:a")
+    cache.put("photo:c", [{"name": "Сыр"}])
+    
+    assert cache.get("photo:b") is None
+    assert cache.get("photo:a") == [{"name": "Хлеб"}]
+    assert cache.hit_rates() == {"photo": 2 / 3}
+
+def test_cached_products_are_not_shared_between_sessions():
+    cache = UploadCache(max_size=2)
+    products = [{"name": "Хлеб", "type": "individual"}]
+    cache.put("csv:hash", products)
+    products[0]["type"] = "shared"
+    cache.get("csv:hash")[0]["type"] = "shared"
+    
+    assert cache.get("csv:hash") == [{"name": "Хлеб", "type": "individual"}]